@@ -0,0 +1,345 @@
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from protocal import *
+
+# Load test for server.py. Starts a server in a scratch folder, fills the
+# history, joins N bots and has them chat at a fixed rate, then prints one
+# JSON object with the results so runs can be compared over time.
+#
+#   python benchmark.py --bots 50 --rate 2 --duration 20 --history 5000
+
+# The seeder never gets further than this ahead of its own echoes, well
+# under OUTBOUND_QUEUE_SIZE, so the slow consumer policy has nothing to drop
+SEED_WINDOW = 500
+SEED_TIMEOUT_S = 120.0
+
+
+def percentiles(values):
+    if not values:
+        return {"count": 0, "p50": None, "p95": None, "p99": None, "max": None}
+    values = sorted(values)
+
+    def pick(p):
+        return round(values[min(len(values) - 1, int(len(values) * p))] * 1000, 3)
+
+    return {"count": len(values), "p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": round(values[-1] * 1000, 3)}
+
+
+def server_rss_kb(pid):
+    # Resident memory of the server and any worker processes (Linux only)
+    def rss(pid):
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return 0
+
+    def children(pid):
+        try:
+            with open(f"/proc/{pid}/task/{pid}/children") as f:
+                return [int(child) for child in f.read().split()]
+        except OSError:
+            return []
+
+    if not os.path.exists(f"/proc/{pid}"):
+        return None
+    return rss(pid) + sum(rss(child) for child in children(pid))
+
+
+def server_counters(path):
+    # Latest counters each server process wrote to METRICS_FILE, summed
+    latest = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    snapshot = json.loads(line)
+                except ValueError:
+                    continue
+                latest[snapshot.get('pid')] = snapshot.get('counters', {})
+    except OSError:
+        pass
+    totals = {}
+    for counters in latest.values():
+        for name, value in counters.items():
+            totals[name] = totals.get(name, 0) + value
+    return totals
+
+
+def counter_delta(before, after, name):
+    return after.get(name, 0) - before.get(name, 0)
+
+
+class Bot:
+
+    def __init__(self, name, stats, framing):
+        self.name = name
+        self.stats = stats
+        self.framing = framing
+        self.reader = None
+        self.writer = None
+        self.frames = None
+        self.frame_writer = None
+        self.received = 0
+        self.last_content = None
+        self.joined = asyncio.Event()
+        self.task = None
+
+    async def connect(self, port):
+        started = time.perf_counter()
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', port, limit=2 ** 24)
+        join_msg = createMessage(self.name, type=MSG_JOIN)
+        join_msg['framing'] = self.framing
+        self.writer.write(serialize(join_msg))
+        await self.writer.drain()
+
+        head = await self.reader.readexactly(FRAME_LENGTH.size)
+        if head.startswith(b'{'):
+            reply = deserialize(head + await self.reader.readline())
+        else:
+            self.frames = FrameReader(self.reader)
+            self.frame_writer = FrameWriter()
+            reply = await self.frames.read(head)
+        if not reply or reply.get('type') != MSG_SUCCESS:
+            raise RuntimeError(f"{self.name} could not join: {reply}")
+
+        self.task = asyncio.create_task(self.read_loop())
+        # The user list comes right after the replay, so it marks the end of the join
+        await self.joined.wait()
+        return time.perf_counter() - started
+
+    async def read(self):
+        if self.frames is None:
+            data = await self.reader.readline()
+            return deserialize(data) if data else None
+        try:
+            return await self.frames.read()
+        except asyncio.IncompleteReadError:
+            return None
+
+    async def read_loop(self):
+        sent_at = self.stats['sent_at']
+        latencies = self.stats['latencies']
+        while True:
+            msg = await self.read()
+            if msg is None:
+                break
+            msg_type = msg.get('type')
+            if msg_type == MSG_PING:
+                self.writer.write(self.pack(createMessage(self.name, type=MSG_PONG, content="")))
+            elif msg_type == MSG_USERLIST:
+                self.joined.set()
+            elif msg_type == MSG_MESSAGE and self.joined.is_set():
+                started = sent_at.get(msg.get('content'))
+                if started is not None:
+                    latencies.append(time.perf_counter() - started)
+                self.received += 1
+                self.last_content = msg.get('content')
+
+    def pack(self, msg):
+        return self.frame_writer.pack(msg) if self.frame_writer else serialize(msg)
+
+    def send(self, content):
+        msg = createMessage(self.name, type=MSG_MESSAGE, content=content)
+        msg['room'] = DEFAULT_ROOM
+        self.writer.write(self.pack(msg))
+
+    async def close(self):
+        if self.writer:
+            self.writer.close()
+        if self.task:
+            self.task.cancel()
+
+
+async def wait_for_port(port, timeout=15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return True
+        except OSError:
+            await asyncio.sleep(0.1)
+    return False
+
+
+async def fill_history(port, count, framing, timeout=SEED_TIMEOUT_S):
+    # One bot sends the whole history, at most SEED_WINDOW messages ahead of
+    # its echoes, then waits for its last message to come back. Returns the
+    # time taken and how many echoes were dropped or never arrived.
+    if count <= 0:
+        return 0.0, 0
+    stats = {'sent_at': {}, 'latencies': []}
+    seeder = Bot("seeder", stats, framing)
+    await seeder.connect(port)
+    started = time.perf_counter()
+    deadline = started + timeout
+    last = f"history {count - 1}"
+    sent = 0
+    while sent < count and time.perf_counter() < deadline:
+        if sent - seeder.received >= SEED_WINDOW:
+            await seeder.writer.drain()
+            await asyncio.sleep(0.01)
+            continue
+        seeder.send(f"history {sent}")
+        sent += 1
+        if sent % 100 == 0:
+            await seeder.writer.drain()
+    await seeder.writer.drain()
+    while seeder.received < count and seeder.last_content != last and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    missing = count - seeder.received
+    await seeder.close()
+    if missing:
+        print(f"{missing} of {count} history messages were dropped or never echoed back", file=sys.stderr)
+    return elapsed, missing
+
+
+async def run_load(bots, rate, duration):
+    # Every bot sends `rate` messages a second for `duration` seconds
+    stats = bots[0].stats
+    interval = 1.0 / rate if rate > 0 else None
+
+    async def chatter(bot, offset):
+        if interval is None:
+            return 0
+        await asyncio.sleep(offset)
+        sent = 0
+        next_send = time.perf_counter()
+        end = next_send + duration
+        while time.perf_counter() < end:
+            content = f"{bot.name} {sent}"
+            stats['sent_at'][content] = time.perf_counter()
+            bot.send(content)
+            sent += 1
+            next_send += interval
+            await asyncio.sleep(max(0.0, next_send - time.perf_counter()))
+        await bot.writer.drain()
+        return sent
+
+    received_before = sum(bot.received for bot in bots)
+    started = time.perf_counter()
+    sent = await asyncio.gather(*(chatter(bot, (i / len(bots)) * (interval or 0)) for i, bot in enumerate(bots)))
+    # Give the last broadcasts a moment to land
+    expected = sum(sent) * len(bots)
+    deadline = time.perf_counter() + 5.0
+    while sum(bot.received for bot in bots) - received_before < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    received = sum(bot.received for bot in bots) - received_before
+    return sum(sent), received, expected, elapsed
+
+
+async def benchmark(args):
+    workdir = tempfile.mkdtemp(prefix="messagefy-bench-")
+    command = [sys.executable, os.path.abspath(os.path.join(os.path.dirname(__file__), "server.py"))]
+    if args.workers > 1:
+        command += ["--workers", str(args.workers)]
+    metrics_file = os.path.join(workdir, "metrics.jsonl")
+    env = dict(os.environ, PORT=str(args.port), METRICS_FILE=metrics_file, METRICS_INTERVAL_S="1")
+    if args.coalesce_bytes is not None:
+        env.update(WRITE_COALESCE_BYTES=str(args.coalesce_bytes))
+    if not args.rate_limits:
+        # The bots are meant to push the server, not to test the limits
+        env.update(RATE_LIMIT_MESSAGES="0", RATE_LIMIT_BYTES="0")
+    log = open(os.path.join(workdir, "server.log"), "w")
+    server = subprocess.Popen(command, cwd=workdir, env=env, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+
+    bots = []
+    try:
+        if not await wait_for_port(args.port):
+            raise RuntimeError("Server did not start, see " + log.name)
+        rss_start = server_rss_kb(server.pid)
+
+        fill_time, fill_missing = await fill_history(args.port, args.history, args.framing)
+
+        stats = {'sent_at': {}, 'latencies': []}
+        join_times = []
+        for i in range(args.bots):
+            bot = Bot(f"bot{i}", stats, args.framing)
+            join_times.append(await bot.connect(args.port))
+            bots.append(bot)
+
+        # Server counters are written once a second, wait for a fresh set
+        await asyncio.sleep(1.2)
+        counters_start = server_counters(metrics_file)
+        sent, received, expected, elapsed = await run_load(bots, args.rate, args.duration)
+        rss_end = server_rss_kb(server.pid)
+        await asyncio.sleep(1.2)
+        counters_end = server_counters(metrics_file)
+        writes = counter_delta(counters_start, counters_end, "socket_writes")
+        messages_out = counter_delta(counters_start, counters_end, "messages_out")
+
+        return {
+            "bots": args.bots,
+            "rate": args.rate,
+            "duration": args.duration,
+            "history": args.history,
+            "workers": args.workers,
+            "framing": args.framing,
+            "history_fill_seconds": round(fill_time, 3),
+            "history_missing": fill_missing,
+            "join_ms": percentiles(join_times),
+            "latency_ms": percentiles(stats['latencies']),
+            "sent": sent,
+            "delivered": received,
+            "expected": expected,
+            "sent_per_sec": round(sent / elapsed, 1) if elapsed else None,
+            "delivered_per_sec": round(received / elapsed, 1) if elapsed else None,
+            "server_socket_writes": writes,
+            "server_messages_out": messages_out,
+            "messages_per_write": round(messages_out / writes, 2) if writes else None,
+            "server_rss_kb": {"start": rss_start, "end": rss_end},
+        }
+    finally:
+        for bot in bots:
+            await bot.close()
+        server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        log.close()
+        if args.keep:
+            print(f"Server folder kept at {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MessageFy server load test")
+    parser.add_argument('--bots', type=int, default=20, help="Number of chatting clients")
+    parser.add_argument('--rate', type=float, default=1.0, help="Messages per second sent by each bot")
+    parser.add_argument('--duration', type=float, default=10.0, help="Seconds of chatting to measure")
+    parser.add_argument('--history', type=int, default=1000, help="Messages in the history before the bots join")
+    parser.add_argument('--workers', type=int, default=0, help="Pass --workers to the server")
+    parser.add_argument('--framing', choices=FRAMINGS, default=FRAMING_JSON, help="Wire format the bots ask for")
+    parser.add_argument('--coalesce-bytes', type=int, help="Pass WRITE_COALESCE_BYTES to the server, 0 writes every message on its own")
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--output', help="Append the result as a JSON line to this file")
+    parser.add_argument('--keep', action='store_true', help="Keep the server folder and log")
+    parser.add_argument('--rate-limits', action='store_true', help="Keep the server's per client rate limits on")
+    args = parser.parse_args()
+
+    result = asyncio.run(benchmark(args))
+    result["timestamp"] = datetime.now().isoformat()
+    line = json.dumps(result)
+    print(line)
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(line + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,100 @@
-import sys
 import time
-import requests
+STARTED = time.perf_counter()
+
+import json
+import os
+import sys
+import threading
 from client_config import load_server_config
-from client_ui import ChatApp
 
 # IMPORTANT: Change this every update
 CURRENT_VERSION = "v1.1.1"
 
-def main():
-    latest_version = str(requests.get("https://raw.githubusercontent.com/Legend-Of-Lonk/MessageFy/refs/heads/main/version.txt").content).strip().strip("'b\\n")
-    if CURRENT_VERSION != latest_version:
-        print(f"Version out of date! Running version {CURRENT_VERSION}, and the latest version is {latest_version}.")
+VERSION_URL = "https://raw.githubusercontent.com/Legend-Of-Lonk/MessageFy/refs/heads/main/version.txt"
+VERSION_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "version_check.json")
+VERSION_CACHE_TTL = 24 * 60 * 60
+VERSION_TIMEOUT = 3
+
+
+def cached_latest_version():
+    try:
+        with open(VERSION_CACHE) as f:
+            cache = json.load(f)
+        return cache.get('latest'), time.time() - cache.get('checked', 0) < VERSION_CACHE_TTL
+    except (OSError, ValueError, AttributeError):
+        return None, False
+
+
+def fetch_latest_version(result):
+    # Runs in a background thread, so a slow or blocked network never holds
+    # up startup. requests is only imported here.
+    try:
+        import requests
+        latest = requests.get(VERSION_URL, timeout=VERSION_TIMEOUT).text.strip()
+        with open(VERSION_CACHE, 'w') as f:
+            json.dump({"latest": latest, "checked": time.time()}, f)
+        result.append(latest)
+    except Exception:
+        pass
+
+
+def start_version_check():
+    # The last known result is used straight away, the network is only
+    # asked once a day and its answer shows up if it arrives in time
+    latest, fresh = cached_latest_version()
+    result = []
+    thread = None
+    if not fresh:
+        thread = threading.Thread(target=fetch_latest_version, args=(result,), daemon=True)
+        thread.start()
+    return latest, result, thread
+
+
+def warn_if_outdated(latest):
+    if latest and CURRENT_VERSION != latest:
+        print(f"Version out of date! Running version {CURRENT_VERSION}, and the latest version is {latest}.")
         print("Download the new version at https://github.com/Legend-Of-Lonk/MessageFy/releases\n\n")
+
+
+def measure_startup(app, marks):
+    # --startup-time: stop once the first frame is drawn instead of connecting
+    async def first_frame(host=None, port=None):
+        marks.append(("mounted", time.perf_counter()))
+
+        def done():
+            marks.append(("first frame", time.perf_counter()))
+            app.exit()
+
+        app.call_after_refresh(done)
+        return True
+
+    app.client.connect = first_frame
+
+
+def print_startup_times(marks):
+    previous = STARTED
+    for name, at in marks:
+        print(f"  {name:<14} {(at - STARTED) * 1000:8.1f} ms  (+{(at - previous) * 1000:.1f} ms)")
+        previous = at
+
+
+def main():
+    startup_time = "--startup-time" in sys.argv
+    if startup_time:
+        sys.argv.remove("--startup-time")
+    marks = [("imports", time.perf_counter())]
+
+    latest_version, version_result, version_thread = start_version_check()
+    if not startup_time:
+        warn_if_outdated(latest_version)
     host, port = load_server_config()
-    print(f"Server: {host}:{port}\n")
+    marks.append(("config", time.perf_counter()))
+    if not startup_time:
+        print(f"Server: {host}:{port}\n")
 
-    if len(sys.argv) < 2:
+    if startup_time:
+        username = sys.argv[1] if len(sys.argv) > 1 else "startup-test"
+    elif len(sys.argv) < 2:
         username = input("Enter your username: ").strip()
         if not username:
             print("Username cannot be empty!")
@@ -25,27 +104,66 @@ def main():
     else:
         username = sys.argv[1]
 
+    # A newer answer from the background check, if it came in while typing
+    if version_result and version_result[0] != latest_version and not startup_time:
+        warn_if_outdated(version_result[0])
+
+    # Textual is only loaded once there is something to show
+    from client_ui import ChatApp
+    from protocal import valid_username, USERNAME_RULES
+    from client_network import RECONNECT_ATTEMPTS, RECONNECT_BASE_DELAY
+    import asyncio
+    import random
+    marks.append(("ui imports", time.perf_counter()))
+
     while True:
+        if not valid_username(username):
+            print(USERNAME_RULES)
+            username = input("Please choose a different username: ").strip()
+            continue
+
         print(f"Connecting as '{username}'...")
 
         try:
             app = ChatApp(username)
             connection_error = [None]
+            server_busy = [False]
 
             original_connect = app.client.connect
 
             async def wrapped_connect(host=None, port=None):
                 result = await original_connect(host, port)
+                # A busy server is no reason to pick another username, come
+                # back when it says to
+                attempts = 0
+                while result != True and app.client.retry_after is not None and attempts < RECONNECT_ATTEMPTS:
+                    delay = app.client.retry_after + random.uniform(0, RECONNECT_BASE_DELAY)
+                    app.client.retry_after = None
+                    app.add_system_message(f"{result}, retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+                    attempts += 1
+                    result = await original_connect(host, port)
                 if result != True and not app.client.reconnecting:
                     connection_error[0] = result
+                    server_busy[0] = app.client.retry_after is not None
                     app.exit()
                 return result
 
             app.client.connect = wrapped_connect
+            if startup_time:
+                measure_startup(app, marks)
             app.run()
 
+            if startup_time:
+                print("Startup time:")
+                print_startup_times(marks)
+                return
+
             if connection_error[0]:
                 print(f"\n{connection_error[0]}")
+                if server_busy[0]:
+                    print("The server is still busy, try again later")
+                    break
                 username = input("Please choose a different username: ").strip()
                 if not username:
                     print("Username cannot be empty!")
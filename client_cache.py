@@ -0,0 +1,107 @@
+import asyncio
+import json
+import os
+import re
+import sqlite3
+
+# Messages this client has already seen, kept in one SQLite file per server
+# so the chat can be shown straight away on startup. The server then only
+# sends what is newer than the newest cached message.
+CACHE_DIR = "message_cache"
+CACHE_MAX_MESSAGES = 50000
+CACHE_TAIL = 1000
+CACHE_FLUSH_DELAY = 1.0
+
+
+def cache_path(host, port):
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    name = re.sub(r'[^A-Za-z0-9.-]', '_', f"{host}_{port}")
+    return os.path.join(script_dir, CACHE_DIR, f"{name}.sqlite3")
+
+
+class MessageCache:
+
+    def __init__(self, host, port, max_messages=CACHE_MAX_MESSAGES):
+        path = cache_path(host, port)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        # It's only a cache, losing the last second of it on a crash is fine
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.execute("CREATE TABLE IF NOT EXISTS messages (room TEXT NOT NULL, seq INTEGER NOT NULL, data TEXT NOT NULL)")
+        self.db.execute("CREATE UNIQUE INDEX IF NOT EXISTS messages_room_seq ON messages (room, seq)")
+        self.db.commit()
+        self.max_messages = max_messages
+        self.pending = []
+        self.flush_handle = None
+
+    def add(self, room, message):
+        # Buffered, so a history replay turns into one transaction
+        self.pending.append((room, message['seq'], json.dumps(message)))
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(CACHE_FLUSH_DELAY, self.flush)
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.pending:
+            return
+        rows, self.pending = self.pending, []
+        try:
+            self.db.executemany("INSERT OR REPLACE INTO messages (room, seq, data) VALUES (?, ?, ?)", rows)
+            self.evict()
+            self.db.commit()
+        except sqlite3.Error:
+            pass
+
+    def evict(self):
+        # Oldest first (rowid order), down to 90% so it doesn't run every flush
+        (count,) = self.db.execute("SELECT COUNT(*) FROM messages").fetchone()
+        if count <= self.max_messages:
+            return
+        keep = self.max_messages * 9 // 10
+        self.db.execute(
+            "DELETE FROM messages WHERE rowid <= (SELECT rowid FROM messages ORDER BY rowid DESC LIMIT 1 OFFSET ?)",
+            (keep,)
+        )
+
+    def messages(self, query, args):
+        self.flush()
+        try:
+            rows = self.db.execute(query, args).fetchall()
+        except sqlite3.Error:
+            return []
+        messages = []
+        for (data,) in reversed(rows):
+            try:
+                messages.append(json.loads(data))
+            except ValueError:
+                pass
+        return messages
+
+    def tail(self, room, limit=CACHE_TAIL):
+        # The newest cached messages of a room, oldest first
+        return self.messages("SELECT data FROM messages WHERE room = ? ORDER BY seq DESC LIMIT ?", (room, limit))
+
+    def before(self, room, seq, limit):
+        # Up to limit messages before seq, oldest first, but only when none
+        # are missing in between, otherwise the server has to fill the gap
+        messages = self.messages(
+            "SELECT data FROM messages WHERE room = ? AND seq < ? ORDER BY seq DESC LIMIT ?", (room, seq, limit)
+        )
+        if len(messages) < limit or messages[-1].get('seq') != seq - 1 or messages[-1]['seq'] - messages[0]['seq'] != limit - 1:
+            return None
+        return messages
+
+    def clear(self, room):
+        self.pending = [row for row in self.pending if row[0] != room]
+        try:
+            self.db.execute("DELETE FROM messages WHERE room = ?", (room,))
+            self.db.commit()
+        except sqlite3.Error:
+            pass
+
+    def close(self):
+        self.flush()
+        self.db.close()
@@ -1,4 +1,5 @@
 import asyncio
+from rich.markup import escape
 from protocal import *
 
 async def handle_command(command, app):
@@ -15,13 +16,16 @@ async def handle_command(command, app):
             app.add_system_message("  /afk - Toggle AFK mode (enable notifications when mentioned)")
             app.add_system_message("  /quit - Disconnect and close the app")
             app.add_system_message("  /nick <new name> - rename yourself")
+            app.add_system_message("  /join <room> - Switch to another room (it is created if needed)")
+            app.add_system_message("  /rooms - List rooms")
+            app.add_system_message("  /mentions - Show where you were mentioned since you last looked")
+            app.add_system_message("  /search <terms> - Search this room's history, /search again for older results")
             app.add_system_message("  /hack - Enter the matrix...")
             return True
 
         elif cmd == '/clear':
             try:
-                chat_display = app.query_one("#chat_messages")
-                chat_display.clear()
+                app.clear_chat()
                 app.add_system_message("Chat display cleared")
             except Exception as e:
                 app.add_system_message(f"Error clearing display: {e}")
@@ -65,6 +69,9 @@ async def handle_command(command, app):
                 app.add_system_message('proper usage: /nick <new_name>')
                 return True
             new_name = parts[1]
+            if not valid_username(new_name):
+                app.add_system_message(USERNAME_RULES)
+                return True
             response = await asyncio.create_task(app.client.fetch_request(CUSTOM_REQUESTS["CHANGE_USERNAME"], new_name))
 
             if response.get('type') == MSG_SUCCESS:
@@ -74,6 +81,54 @@ async def handle_command(command, app):
             app.add_system_message(response.get('content'))
 
             return True
+
+        elif cmd == '/join':
+            if len(parts) < 2:
+                app.add_system_message('proper usage: /join <room>')
+                return True
+            room = parts[1].lstrip('#')
+            if await app.client.join_room(room):
+                app.add_system_message(f"[bold green]You are now in #{room}[/bold green]")
+            return True
+
+        elif cmd == '/mentions':
+            messages = await app.client.fetch_mentions()
+            if messages is None:
+                return True
+            if not messages:
+                app.add_system_message(f"No new mentions in #{app.client.room}")
+                return True
+            app.add_system_message(f"Mentions in #{app.client.room}:")
+            for msg in messages:
+                app.add_message(str(msg.get('sender')), str(msg.get('content')))
+            return True
+
+        elif cmd == '/search':
+            terms, messages, has_more = await app.client.search(command[len(parts[0]):].strip())
+            if terms is None:
+                app.add_system_message('proper usage: /search <terms>')
+                return True
+            if messages is None:
+                return True
+            if not messages:
+                app.add_system_message(f"No results for '{escape(terms)}' in #{app.client.room}")
+                return True
+            app.add_system_message(f"Results for '{escape(terms)}' in #{app.client.room}:")
+            for msg in messages:
+                app.add_message(str(msg.get('sender')), str(msg.get('content')))
+            if has_more:
+                app.add_system_message("Type /search for older results")
+            return True
+
+        elif cmd == '/rooms':
+            room_list = await app.client.fetch_rooms()
+            if room_list is None:
+                return True
+            app.add_system_message("Rooms:")
+            for room in room_list:
+                marker = " (you are here)" if room.get('name') == app.client.room else ""
+                app.add_system_message(f"  #{room.get('name')} - {room.get('users')} online{marker}")
+            return True
             
 
     return False
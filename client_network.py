@@ -1,7 +1,21 @@
 import asyncio
+import random
 from protocal import *
 import time
 from client_config import load_server_config
+from client_cache import MessageCache
+
+
+# Reconnect backoff in seconds. Each wait is picked at random between the
+# base and three times the previous one, so clients that lost the server at
+# the same moment don't all come back at the same moment.
+RECONNECT_ATTEMPTS = 8
+RECONNECT_BASE_DELAY = 1.0
+RECONNECT_MAX_DELAY = 30.0
+
+
+def backoff_delay(previous):
+    return min(RECONNECT_MAX_DELAY, random.uniform(RECONNECT_BASE_DELAY, max(previous, RECONNECT_BASE_DELAY) * 3))
 
 
 class ChatClient:
@@ -17,31 +31,87 @@ class ChatClient:
         self.request_counter = 0
         self.intentional_disconnect = False
         self.reconnecting = False
+        self.last_seen_seq = None
+        self.resync = True
+        self.users = []
+        self.presence_version = None
+        self.refreshing_users = False
+        self.room = DEFAULT_ROOM
+        self.frames = None
+        self.frame_writer = None
+        self.last_received = time.monotonic()
+        self.watchdog_task = None
+        self.max_message_chars = 500
+        self.retry_after = None
+        self.cache = None
+        self.cache_shown = False
+        # Per room, the seq after which /mentions looks for new mentions
+        self.mentions_after = {}
+        # (room, terms, cursor) of the last /search, so a bare /search pages back
+        self.last_search = None
 
     async def connect(self, host=None, port=None):
         if host is None or port is None:
             host, port = load_server_config()
+        if self.cache is None:
+            self.open_cache(host, port)
+        if self.last_seen_seq is None and not self.reconnecting:
+            self.show_cached()
         try:
-            self.reader, self.writer = await asyncio.open_connection(host, port)
+            self.reader, self.writer = await asyncio.open_connection(host, port, limit=MAX_FRAME_SIZE)
             self.connected = True
 
             join_msg = createMessage(self.username, type=MSG_JOIN)
+            join_msg['room'] = self.room
+            join_msg['framing'] = FRAMING_BINARY
+            if self.last_seen_seq is not None:
+                join_msg['last_seen_seq'] = self.last_seen_seq
+                # Whatever mentioned us from here on happened while we were away
+                self.mentions_after.setdefault(self.room, self.last_seen_seq)
             self.writer.write(serialize(join_msg))
             await self.writer.drain()
 
-            data = await asyncio.wait_for(self.reader.readline(), timeout=5.0)
-            if data:
-                msg = deserialize(data)
-                if msg:
-                    if msg.get('type') == MSG_ERROR:
-                        self.connected = False
-                        error_content = msg.get('content')
-                        self.writer.close()
-                        await self.writer.wait_closed()
-                        return error_content
-                    elif msg.get('type') == MSG_SUCCESS:
-                        asyncio.create_task(self.receive_messages())
-                        return True
+            # Servers that don't know binary framing (and every handshake
+            # error) answer with a JSON line, which always starts with {
+            self.frames = None
+            self.frame_writer = None
+            head = await asyncio.wait_for(self.reader.readexactly(FRAME_LENGTH.size), timeout=5.0)
+            if head.startswith(b'{'):
+                msg = deserialize(head + await asyncio.wait_for(self.reader.readline(), timeout=5.0))
+            else:
+                self.frames = FrameReader(self.reader)
+                self.frame_writer = FrameWriter()
+                msg = await asyncio.wait_for(self.frames.read(head), timeout=5.0)
+            if msg:
+                if msg.get('type') == MSG_ERROR:
+                    self.connected = False
+                    error_content = msg.get('content')
+                    # A busy server says how long to stay away
+                    retry_after = msg.get('retry_after')
+                    if isinstance(retry_after, (int, float)) and not isinstance(retry_after, bool):
+                        self.retry_after = min(max(retry_after, 0), RECONNECT_MAX_DELAY)
+                    self.writer.close()
+                    await self.writer.wait_closed()
+                    return error_content
+                elif msg.get('type') == MSG_SUCCESS:
+                    if valid_room_name(msg.get('room')) and msg['room'] != self.room:
+                        # The server could not open the room we asked for
+                        self.room = msg['room']
+                        self.last_seen_seq = None
+                        self.app.set_room(self.room)
+                    # The server either replays only what we missed or asks for a full resync
+                    self.resync = msg.get('resync', True)
+                    if self.resync:
+                        self.last_seen_seq = None
+                        self.forget_cached()
+                    self.cache_shown = False
+                    self.loading_history = True
+                    self.start_watchdog(msg.get('heartbeat'))
+                    limits = msg.get('limits')
+                    if isinstance(limits, dict) and isinstance(limits.get('max_message_chars'), int):
+                        self.max_message_chars = limits['max_message_chars']
+                    asyncio.create_task(self.receive_messages())
+                    return True
 
             asyncio.create_task(self.receive_messages())
             return True
@@ -51,18 +121,88 @@ class ChatClient:
             self.app.add_system_message(f"Connection failed: {e}")
             return f"Connection failed: {e}"
 
+    def open_cache(self, host, port):
+        try:
+            self.cache = MessageCache(host, port)
+        except Exception as e:
+            self.app.add_system_message(f"Message cache disabled: {e}")
+
+    def show_cached(self, messages=None):
+        # Draw what we already have for this room and ask the server only
+        # for what came after it
+        if self.cache is None:
+            return
+        if messages is None:
+            messages = self.cache.tail(self.room)
+        for msg in messages:
+            if msg.get('type') == MSG_MESSAGE:
+                self.app.add_message(msg.get('sender'), msg.get('content'), loading_history=True, seq=msg.get('seq'))
+            elif msg.get('type') in (MSG_JOIN, MSG_LEAVE):
+                self.app.add_system_message(msg.get('content'), seq=msg.get('seq'))
+        if messages:
+            self.last_seen_seq = messages[-1].get('seq')
+            self.cache_shown = True
+
+    def forget_cached(self):
+        # The server could not continue from the cache (its history was
+        # reset or we are too far behind), so start the room over
+        if self.cache:
+            self.cache.clear(self.room)
+        if self.cache_shown:
+            self.cache_shown = False
+            self.app.clear_chat()
+
+    def start_watchdog(self, heartbeat):
+        if self.watchdog_task:
+            self.watchdog_task.cancel()
+            self.watchdog_task = None
+        self.last_received = time.monotonic()
+        # Older servers don't ping, so only watch when the server says it will
+        if isinstance(heartbeat, dict) and heartbeat.get('interval') and heartbeat.get('timeout'):
+            self.watchdog_task = asyncio.create_task(self.watchdog(heartbeat['interval'], heartbeat['timeout']))
+
+    async def watchdog(self, interval, timeout):
+        writer = self.writer
+        while self.connected and writer is self.writer:
+            await asyncio.sleep(interval)
+            if time.monotonic() - self.last_received > timeout:
+                self.app.add_system_message("Server stopped responding")
+                # Aborting wakes up receive_messages, which then reconnects
+                writer.transport.abort()
+                return
+
+    def pack(self, message):
+        if self.frame_writer is None:
+            return serialize(message)
+        return self.frame_writer.pack(message)
+
+    async def read_message(self):
+        # None once the server is gone, {} for anything that could not be decoded
+        if self.frames is None:
+            data = await self.reader.readline()
+            if not data:
+                return None
+            return deserialize(data) or {}
+        try:
+            return await self.frames.read()
+        except asyncio.IncompleteReadError:
+            return None
+
     async def send_message(self, content):
         if not self.connected:
             return
 
         try:
             msg = createMessage(self.username, type=MSG_MESSAGE, content=content)
-            self.writer.write(serialize(msg))
+            msg['room'] = self.room
+            self.writer.write(self.pack(msg))
             await self.writer.drain()
         except Exception as e:
             self.app.add_system_message(f"Error sending message: {e}")
 
-    async def fetch_request(self, type, content):
+    async def fetch_request(self, type, content, on_reply=None):
+        # on_reply runs in receive_messages as soon as the reply is read,
+        # before anything the server sent after it
         if not self.connected:
             return None
         try:
@@ -70,11 +210,12 @@ class ChatClient:
             request_id = f"{self.username}_{self.request_counter}"
 
             future = asyncio.Future()
-            self.pending_requests[request_id] = future
+            self.pending_requests[request_id] = (future, on_reply)
 
             msg = createMessage(self.username, type, content)
             msg['request_id'] = request_id
-            self.writer.write(serialize(msg))
+            msg['room'] = self.room
+            self.writer.write(self.pack(msg))
             await self.writer.drain()
 
             result = await asyncio.wait_for(future, timeout=5.0)
@@ -88,14 +229,174 @@ class ChatClient:
             self.app.add_system_message(f"Error sending request: {e}")
             return None
 
+    async def fetch_history(self, before=None, after=None, limit=None):
+        query = {}
+        if before is not None:
+            query['before'] = before
+        if after is not None:
+            query['after'] = after
+        if limit is not None:
+            query['limit'] = limit
+        return await self.fetch_request(FETCH_REQUESTS["GET_HISTORY"], query)
+
+    async def fetch_older(self, before, limit=100):
+        # One page of the current room's messages before a seq, oldest
+        # first, and whether there are more
+        room = self.room
+        if self.cache:
+            messages = self.cache.before(room, before, limit)
+            if messages is not None:
+                return messages, True
+        response = await self.fetch_history(before=before, limit=limit)
+        if not response or response.get('type') != MSG_HISTORY:
+            return None, False
+        messages = [msg for msg in response.get('content') or [] if isinstance(msg, dict)]
+        if self.cache:
+            for msg in messages:
+                if isinstance(msg.get('seq'), int):
+                    self.cache.add(room, msg)
+        return messages, response.get('has_more', False)
+
+    async def fetch_mentions(self):
+        # Mentions of us in the current room since the last call (or since
+        # we were last here), oldest first
+        room = self.room
+        query = {}
+        if self.mentions_after.get(room) is not None:
+            query['after'] = self.mentions_after[room]
+        response = await self.fetch_request(FETCH_REQUESTS["GET_MENTIONS"], query)
+        if not response or response.get('type') != MSG_HISTORY:
+            return None
+        messages = [msg for msg in response.get('content') or [] if isinstance(msg, dict)]
+        if messages and isinstance(messages[-1].get('seq'), int):
+            self.mentions_after[room] = messages[-1]['seq']
+        return messages
+
+    async def search(self, terms=None, limit=20):
+        # Newest matches for terms in the current room, oldest first. With
+        # no terms, the next older page of the previous search. Returns
+        # (terms, messages, has_more), messages is None on failure.
+        room = self.room
+        before = None
+        if not terms:
+            if not self.last_search or self.last_search[0] != room:
+                return None, None, False
+            _, terms, before = self.last_search
+            if before is None:
+                return terms, [], False
+        query = {"query": terms, "limit": limit}
+        if before is not None:
+            query['before'] = before
+        response = await self.fetch_request(FETCH_REQUESTS["SEARCH"], query)
+        if not response or response.get('type') != MSG_HISTORY:
+            if response:
+                self.app.add_system_message(str(response.get('content')))
+            return terms, None, False
+        messages = [msg for msg in response.get('content') or [] if isinstance(msg, dict)]
+        has_more = response.get('has_more', False)
+        cursor = messages[0].get('seq') if messages and has_more else None
+        self.last_search = (room, terms, cursor)
+        return terms, messages, has_more
+
+    async def join_room(self, room):
+        if room == self.room:
+            self.app.add_system_message(f"You are already in #{room}")
+            return False
+        if not valid_room_name(room):
+            self.app.add_system_message("Room names are 1-32 letters, digits, - or _")
+            return False
+
+        old_room = self.room
+        cached = self.cache.tail(room) if self.cache else []
+        cached_seq = cached[-1].get('seq') if cached else None
+
+        def switch(reply):
+            # Nothing about the current room changes until the server says
+            # yes, then the switch happens before the replay is read
+            if reply.get('type') != MSG_SUCCESS:
+                return
+            self.room = room
+            self.last_seen_seq = None
+            self.loading_history = True
+            self.users = []
+            self.presence_version = None
+            self.app.clear_chat()
+            if reply.get('resync', True):
+                if self.cache:
+                    self.cache.clear(room)
+            else:
+                self.show_cached(cached)
+                self.mentions_after.setdefault(room, cached_seq)
+            self.cache_shown = False
+
+        query = {"room": room}
+        if cached_seq is not None:
+            query['last_seen_seq'] = cached_seq
+        response = await self.fetch_request(CUSTOM_REQUESTS["JOIN_ROOM"], query, on_reply=switch)
+        if not response or response.get('type') != MSG_SUCCESS:
+            if response:
+                self.app.add_system_message(response.get('content'))
+            self.app.add_system_message(f"Could not join #{room}, you are still in #{old_room}")
+            return False
+
+        self.app.set_room(room)
+        leave_msg = createMessage(self.username, CUSTOM_REQUESTS["LEAVE_ROOM"], old_room)
+        self.writer.write(self.pack(leave_msg))
+        await self.writer.drain()
+        return True
+
+    async def fetch_rooms(self):
+        response = await self.fetch_request(FETCH_REQUESTS["GET_ROOM_LIST"], None)
+        if response and response.get('type') == MSG_ROOM_LIST:
+            return response.get('content')
+        return None
+
+    def set_user_list(self, users, version):
+        self.users = list(users or [])
+        self.presence_version = version
+        self.app.update_user_list(self.users)
+
+    def apply_presence(self, msg):
+        version = msg.get('version')
+        if self.presence_version is not None and version is not None and version <= self.presence_version:
+            return
+        if self.presence_version is None and self.loading_history:
+            # Presence overtakes the replay, the full list is still on its way
+            return
+        if self.presence_version is None or version != self.presence_version + 1:
+            # Missed an update somewhere, get the full list again
+            if not self.refreshing_users:
+                asyncio.create_task(self.refresh_user_list())
+            return
+
+        content = msg.get('content')
+        msg_type = msg.get('type')
+        if msg_type == MSG_USER_JOINED and content not in self.users:
+            self.users.append(content)
+        elif msg_type == MSG_USER_LEFT and content in self.users:
+            self.users.remove(content)
+        elif msg_type == MSG_USER_RENAMED and isinstance(content, dict):
+            self.users = [content.get('new') if user == content.get('old') else user for user in self.users]
+
+        self.presence_version = version
+        self.app.update_user_list(self.users)
+
+    async def refresh_user_list(self):
+        self.refreshing_users = True
+        try:
+            response = await self.fetch_request(FETCH_REQUESTS["GET_USER_LIST"], self.presence_version)
+            if response and response.get('type') == MSG_USERLIST:
+                self.set_user_list(response.get('content'), response.get('version'))
+        finally:
+            self.refreshing_users = False
+
     async def receive_messages(self):
         try:
             while self.connected:
-                data = await self.reader.readline()
-                if not data:
+                msg = await self.read_message()
+                if msg is None:
                     break
-
-                msg = deserialize(data)
+                self.last_received = time.monotonic()
                 if not msg:
                     continue
 
@@ -103,24 +404,48 @@ class ChatClient:
                 sender = msg.get('sender')
                 content = msg.get('content')
                 request_id = msg.get('request_id')
+                seq = msg.get('seq')
+
+                if msg_type == MSG_PING:
+                    self.writer.write(self.pack(createMessage(self.username, type=MSG_PONG, content=content)))
+                    continue
 
                 if request_id and request_id in self.pending_requests:
-                    future = self.pending_requests.pop(request_id)
+                    future, on_reply = self.pending_requests.pop(request_id)
+                    if on_reply:
+                        on_reply(msg)
                     if not future.done():
                         future.set_result(msg)
                     continue
 
+                # Only the room we are looking at is shown, server wide
+                # announcements have no room at all
+                room = msg.get('room')
+                if room is not None and room != self.room:
+                    continue
+
+                if seq is not None:
+                    if self.last_seen_seq is not None and seq <= self.last_seen_seq:
+                        continue
+                    self.last_seen_seq = seq
+                    if self.cache and msg_type in (MSG_MESSAGE, MSG_JOIN, MSG_LEAVE):
+                        self.cache.add(room or self.room, msg)
+
                 if msg_type == MSG_MESSAGE:
-                    self.app.add_message(sender, content, loading_history=self.loading_history)
+                    self.app.add_message(sender, content, loading_history=self.loading_history, seq=seq)
                 elif msg_type == MSG_JOIN:
-                    self.app.add_system_message(content)
+                    self.app.add_system_message(content, seq=seq)
                 elif msg_type == MSG_LEAVE:
-                    self.app.add_system_message(content)
+                    self.app.add_system_message(content, seq=seq)
                 elif msg_type == MSG_USERLIST:
                     self.loading_history = False
-                    self.app.update_user_list(content)
+                    self.set_user_list(content, msg.get('version'))
+                elif msg_type in PRESENCE_EVENTS:
+                    self.apply_presence(msg)
+                elif msg_type == MSG_MENTION:
+                    self.app.show_mention(sender, content)
                 elif msg_type == MSG_ERROR:
-                    pass
+                    self.app.add_system_message(f"[red]{content}[/red]")
 
         except Exception as e:
             self.app.add_system_message(f"Connection error: {e}")
@@ -133,16 +458,20 @@ class ChatClient:
             self.app.add_system_message("Disconnected from server")
 
             self.reconnecting = True
-            for i in range(5):
-                self.app.add_system_message(f"Attempting to reconnect - Attempt {i + 1}/5")
+            # A short random wait first, so a server restart isn't met by
+            # every client at once
+            delay = random.uniform(0, RECONNECT_BASE_DELAY)
+            for i in range(RECONNECT_ATTEMPTS):
+                if self.retry_after:
+                    delay = max(delay, self.retry_after + random.uniform(0, RECONNECT_BASE_DELAY))
+                    self.retry_after = None
+                self.app.add_system_message(f"Reconnecting in {delay:.1f}s - Attempt {i + 1}/{RECONNECT_ATTEMPTS}")
+                await asyncio.sleep(delay)
                 try:
                     result = await self.connect()
                     if result is True:
-                        try:
-                            chat_display = self.app.query_one("#chat_messages")
-                            chat_display.clear()
-                        except Exception:
-                            pass
+                        if self.resync:
+                            self.app.clear_chat()
                         self.app.add_system_message("Successfully reconnected to server!")
                         self.reconnecting = False
                         return
@@ -150,12 +479,10 @@ class ChatClient:
                         self.app.add_system_message(f"Reconnection failed: {result}")
                 except Exception as e:
                     self.app.add_system_message(f"Reconnection attempt failed: {e}")
-
-                if i < 4:
-                    await asyncio.sleep(2)
+                delay = backoff_delay(delay)
 
             self.reconnecting = False
-            self.app.add_system_message("Failed to reconnect after 5 attempts")
+            self.app.add_system_message(f"Failed to reconnect after {RECONNECT_ATTEMPTS} attempts")
 
     async def disconnect(self):
         if not self.connected:
@@ -163,8 +490,13 @@ class ChatClient:
 
         try:
             self.intentional_disconnect = True
+            if self.cache:
+                self.cache.flush()
+            if self.watchdog_task:
+                self.watchdog_task.cancel()
+                self.watchdog_task = None
             leave_msg = createMessage(self.username, type=MSG_LEAVE)
-            self.writer.write(serialize(leave_msg))
+            self.writer.write(self.pack(leave_msg))
             await self.writer.drain()
 
             self.connected = False
@@ -0,0 +1,69 @@
+import queue
+import threading
+import time
+
+# Desktop notifications are sent from a worker thread, since notifypy starts
+# a process (and plays a sound) for every one. Anything that comes in within
+# COALESCE_WINDOW of the first is folded into the same notification.
+COALESCE_WINDOW = 2.0
+PREVIEW_CHARS = 100
+
+
+def preview(content):
+    return content[:PREVIEW_CHARS] + "..." if len(content) > PREVIEW_CHARS else content
+
+
+class Notifier:
+
+    def __init__(self, app_name="MessageFy", window=COALESCE_WINDOW):
+        self.app_name = app_name
+        self.window = window
+        self.queue = queue.Queue()
+        self.thread = None
+        self.notification = None
+
+    def notify(self, sender, content, mentioned=False):
+        # Never blocks, the worker is started the first time it is needed
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        self.queue.put((sender, content, mentioned))
+
+    def run(self):
+        while True:
+            burst = [self.queue.get()]
+            deadline = time.monotonic() + self.window
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    burst.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self.send(*self.summarize(burst))
+            except Exception:
+                pass
+
+    def summarize(self, burst):
+        sender, content, mentioned = burst[-1]
+        if len(burst) == 1:
+            if mentioned:
+                return f"{sender} mentioned you!", preview(content)
+            return f"New message from {sender}", preview(content)
+
+        senders = list(dict.fromkeys(item[0] for item in burst))
+        names = ", ".join(senders[:3]) + (f" and {len(senders) - 3} more" if len(senders) > 3 else "")
+        kind = "mentions" if all(item[2] for item in burst) else "messages"
+        return f"{len(burst)} new {kind} from {names}", f"{sender}: {preview(content)}"
+
+    def send(self, title, message):
+        if self.notification is None:
+            # Only loaded the first time someone is notified
+            from notifypy import Notify
+            self.notification = Notify()
+            self.notification.application_name = self.app_name
+        self.notification.title = title
+        self.notification.message = message
+        self.notification.send()
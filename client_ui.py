@@ -1,10 +1,58 @@
 import asyncio
+from collections import deque
+from rich.markup import escape
+from rich.segment import Segment
+from rich.text import Text
 from textual.app import App, ComposeResult
 from textual.widgets import Input, RichLog, Static
 from textual.containers import Horizontal, Vertical, VerticalScroll
 from client_network import ChatClient
 from client_commands import handle_command
-from notifypy import Notify
+from client_notifications import Notifier
+from protocal import MSG_MESSAGE, MSG_JOIN, MSG_LEAVE, MENTION_PATTERN
+
+# Incoming lines are buffered and written to the log at most this often, so
+# a history replay costs one render per frame instead of one per message
+RENDER_INTERVAL = 1 / 30
+RENDER_BLOCK = 50
+# The log keeps about this many messages. Scrolling to the top loads older
+# pages from the server, up to twice as many, and they are trimmed again once
+# you are back at the bottom. Trimming waits until a page over the limit.
+SCROLLBACK_MESSAGES = 1000
+SCROLLBACK_PAGE = 100
+
+
+class RenderedLines:
+    # Lines the log already rendered, written back without rendering again
+
+    def __init__(self, strips):
+        self.strips = strips
+
+    def __rich_console__(self, console, options):
+        for strip in self.strips:
+            yield from strip
+            yield Segment.line()
+
+
+class ChatLog(RichLog):
+    # RichLog that can also drop its oldest lines and insert older ones above
+    # what it already shows. RichLog has no public way to do either, so the
+    # log is cleared and what stays is written back, already rendered.
+
+    def drop_top(self, count):
+        kept = self.lines[count:]
+        self.clear()
+        if kept:
+            self.write(RenderedLines(kept), scroll_end=False)
+
+    def prepend(self, content):
+        kept = list(self.lines)
+        self.clear()
+        self.write(content, scroll_end=False)
+        added = len(self.lines)
+        if kept:
+            self.write(RenderedLines(kept), scroll_end=False)
+        return added
 
 
 class ChatApp(App):
@@ -17,12 +65,22 @@ class ChatApp(App):
         self.username = username
         self.client = ChatClient(username, self)
         self.notifications_enabled = True
+        self.notifier = Notifier()
         self.afk_mode = False
         self.last_activity = None
         self.afk_timer_task = None
+        self.chat_log = None
+        self.pending_lines = []
+        self.render_scheduled = False
+        # [first seq, messages, rendered lines] for each write, oldest first
+        self.blocks = deque()
+        self.has_older = True
+        self.loading_older = False
 
     def on_mount(self) -> None:
         import time
+        self.chat_log = self.query_one("#chat_messages", ChatLog)
+        self.watch(self.chat_log, "scroll_y", self.on_chat_scroll, init=False)
         self.last_activity = time.time()
         asyncio.create_task(self.client.connect())
         self.afk_timer_task = asyncio.create_task(self.check_afk_timer())
@@ -35,14 +93,17 @@ class ChatApp(App):
         if self.afk_timer_task:
             self.afk_timer_task.cancel()
 
+        if self.client.cache:
+            self.client.cache.flush()
+
         if self.client.connected:
             asyncio.create_task(self.client.disconnect())
 
     def compose(self) -> ComposeResult:
-        yield Static("MessageFy", id="header")
+        yield Static(f"MessageFy  #{self.client.room}", id="header")
         with Horizontal(id="main_container"):
             with Vertical(id="chat_container"):
-                yield RichLog(id="chat_messages", highlight=True, markup=True, auto_scroll=True, wrap=True)
+                yield ChatLog(id="chat_messages", highlight=True, markup=True, auto_scroll=True, wrap=True)
 
             with VerticalScroll(id="users_container"):
                 yield Static("No users connected", id="users_list")
@@ -55,8 +116,8 @@ class ChatApp(App):
 
         message = event.value.strip()
 
-        if len(message) > 500:
-            self.add_system_message("Message greator than 500 charecters please shorten it")
+        if len(message) > self.client.max_message_chars:
+            self.add_system_message(f"Message greator than {self.client.max_message_chars} charecters please shorten it")
             return
 
         if message:
@@ -79,54 +140,150 @@ class ChatApp(App):
             return f"[black on bright_cyan]@{mentioned_user}[/black on bright_cyan]"
         return f"[black on orange1]@{mentioned_user}[/black on orange1]"
 
-    def add_message(self, sender, content, loading_history=False):
-        from rich.markup import escape
-        import re
-        try:
-            chat_display = self.query_one("#chat_messages", RichLog)
-            safe_sender = escape(sender)
-
-            is_mentioned = f"@{self.username}" in content
+    def format_message(self, sender, content):
+        safe_sender = escape(sender)
+        content = MENTION_PATTERN.sub(self._highlight_mention, content)
+        if sender == self.username:
+            return f"[bold cyan]{safe_sender}[/bold cyan]: {content}"
+        return f"[bold yellow]{safe_sender}[/bold yellow]: {content}"
 
-            content = re.sub(r'@(\w+)', self._highlight_mention, content)
+    def format_history(self, msg):
+        # Markup for a message from a history page, None for anything not shown
+        content = msg.get('content')
+        if not isinstance(content, str):
+            return None
+        if msg.get('type') == MSG_MESSAGE:
+            return self.format_message(str(msg.get('sender')), content)
+        if msg.get('type') in (MSG_JOIN, MSG_LEAVE):
+            return f"[dim italic]{content}[/dim italic]"
+        return None
 
-            if sender == self.username:
-                chat_display.write(f"[bold cyan]{safe_sender}[/bold cyan]: {content}")
-            else:
-                chat_display.write(f"[bold yellow]{safe_sender}[/bold yellow]: {content}")
-                if is_mentioned and not loading_history and self.afk_mode:
-                    self.send_desktop_notification(sender, content, mentioned=True)
+    def add_message(self, sender, content, loading_history=False, seq=None):
+        try:
+            self.queue_line(self.format_message(sender, content), seq)
         except Exception:
             pass
 
-    def send_desktop_notification(self, sender, content, mentioned=False):
-        if not self.notifications_enabled:
+    def show_mention(self, sender, mention):
+        # The server tells us when we are mentioned, in any room
+        if not isinstance(mention, dict):
             return
+        room = mention.get('room')
+        text = str(mention.get('text', ''))
+        if room != self.client.room:
+            self.add_system_message(f"[bold]{escape(str(sender))} mentioned you in #{room}:[/bold] {escape(text)}")
+        if self.afk_mode:
+            self.send_desktop_notification(sender, text, mentioned=True)
 
+    def queue_line(self, markup, seq=None):
+        self.pending_lines.append((seq, markup))
+        if not self.render_scheduled:
+            self.render_scheduled = True
+            self.set_timer(RENDER_INTERVAL, self.render_pending)
+
+    def render_text(self, lines):
+        texts = []
+        for line in lines:
+            # Markup is parsed per line so an unclosed tag can't spill over
+            try:
+                texts.append(Text.from_markup(line))
+            except Exception:
+                texts.append(Text(line))
+        return self.chat_log.highlighter(Text("\n").join(texts))
+
+    def render_pending(self):
+        self.render_scheduled = False
+        if not self.pending_lines or self.chat_log is None:
+            return
+        if not self.chat_log.scrollable_content_region.width:
+            # Not laid out yet, so nothing could be measured
+            self.render_scheduled = True
+            self.set_timer(RENDER_INTERVAL, self.render_pending)
+            return
+        lines, self.pending_lines = self.pending_lines, []
+
+        # Written in blocks so the scrollback can be trimmed a block at a time
+        at_end = self.chat_log.is_vertical_scroll_end
+        for start in range(0, len(lines), RENDER_BLOCK):
+            block = lines[start:start + RENDER_BLOCK]
+            before = len(self.chat_log.lines)
+            self.chat_log.write(self.render_text([markup for _, markup in block]), scroll_end=at_end)
+            first_seq = next((seq for seq, _ in block if seq is not None), None)
+            self.blocks.append([first_seq, len(block), len(self.chat_log.lines) - before])
+        self.trim_scrollback(SCROLLBACK_MESSAGES if at_end else SCROLLBACK_MESSAGES * 2)
+
+    def trim_scrollback(self, limit):
+        total = sum(block[1] for block in self.blocks)
+        if total <= limit + SCROLLBACK_PAGE:
+            return
+        dropped = 0
+        while total > limit and len(self.blocks) > 1:
+            block = self.blocks.popleft()
+            total -= block[1]
+            dropped += block[2]
+        if dropped:
+            scroll_y = self.chat_log.scroll_y
+            self.chat_log.drop_top(dropped)
+            self.has_older = True
+            if not self.chat_log.is_vertical_scroll_end:
+                self.chat_log.scroll_to(y=max(0, scroll_y - dropped), animate=False)
+
+    def oldest_seq(self):
+        for block in self.blocks:
+            if block[0] is not None:
+                return block[0]
+        return None
+
+    def on_chat_scroll(self, scroll_y):
+        if scroll_y <= 0 and self.has_older and not self.loading_older:
+            asyncio.create_task(self.load_older())
+
+    async def load_older(self):
+        before = self.oldest_seq()
+        room = self.client.room
+        room_left = SCROLLBACK_MESSAGES * 2 - sum(block[1] for block in self.blocks)
+        if before is None or room_left <= 0:
+            return
+        self.loading_older = True
         try:
-            notification = Notify()
-            notification.application_name = "MessageFy"
+            messages, has_more = await self.client.fetch_older(before, min(SCROLLBACK_PAGE, room_left))
+            # The room may have changed or the log moved on while waiting
+            if messages is None or room != self.client.room or before != self.oldest_seq():
+                return
+            self.has_older = has_more
+            lines = [(msg.get('seq'), self.format_history(msg)) for msg in messages]
+            lines = [(seq, markup) for seq, markup in lines if markup is not None]
+            if not lines:
+                return
+            added = self.chat_log.prepend(self.render_text([markup for _, markup in lines]))
+            self.blocks.appendleft([lines[0][0], len(lines), added])
+            # Keep what was on screen where it was
+            self.chat_log.scroll_to(y=self.chat_log.scroll_y + added, animate=False)
+        finally:
+            self.loading_older = False
 
-            if mentioned:
-                notification.title = f"{sender} mentioned you!"
-                truncated_content = content[:100] + "..." if len(content) > 100 else content
-                notification.message = truncated_content
-            else:
-                notification.title = f"New message from {sender}"
-                truncated_content = content[:100] + "..." if len(content) > 100 else content
-                notification.message = truncated_content
+    def send_desktop_notification(self, sender, content, mentioned=False):
+        if not self.notifications_enabled:
+            return
+        self.notifier.notify(sender, content, mentioned)
 
-            notification.send()
-        except:
-            pass
+    def clear_chat(self):
+        self.pending_lines = []
+        self.blocks.clear()
+        self.has_older = True
+        if self.chat_log is not None:
+            self.chat_log.clear()
 
-    def add_system_message(self, content):
+    def set_room(self, room):
         try:
-            chat_display = self.query_one("#chat_messages", RichLog)
-            chat_display.write(f"[dim italic]{content}[/dim italic]")
+            header = self.query_one("#header", Static)
+            header.update(f"MessageFy  #{room}")
         except Exception:
             pass
 
+    def add_system_message(self, content, seq=None):
+        self.queue_line(f"[dim italic]{content}[/dim italic]", seq)
+
     def update_user_list(self, users):
         try:
             users_list = self.query_one("#users_list", Static)
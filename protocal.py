@@ -1,4 +1,6 @@
 import json
+import re
+import struct
 from datetime import datetime
 
 MSG_JOIN = "JOIN"
@@ -7,8 +9,38 @@ MSG_MESSAGE = "MESSAGE"
 MSG_USERLIST = "USER_LIST"
 MSG_ERROR = "ERROR"
 MSG_SUCCESS = "SUCCESS"
-FETCH_REQUESTS = {"GET_USER_LIST": "FETCH_USER_LIST"}
-CUSTOM_REQUESTS = {"CHANGE_USERNAME": "CHANGE_USERNAME"}
+MSG_HISTORY = "HISTORY"
+MSG_USER_JOINED = "USER_JOINED"
+MSG_USER_LEFT = "USER_LEFT"
+MSG_USER_RENAMED = "USER_RENAMED"
+PRESENCE_EVENTS = (MSG_USER_JOINED, MSG_USER_LEFT, MSG_USER_RENAMED)
+MSG_ROOM_LIST = "ROOM_LIST"
+MSG_PING = "PING"
+MSG_PONG = "PONG"
+MSG_MENTION = "MENTION"
+DEFAULT_ROOM = "general"
+ROOM_NAME_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,32}$')
+# Usernames may have . and - inside but start and end with a word
+# character, so an @mention ends exactly where the name does
+USERNAME_PATTERN = re.compile(r'^\w(?:[\w.-]{0,30}\w)?$')
+USERNAME_RULES = "Usernames can use letters, numbers, _, - and . (not first or last), max 32"
+MENTION_PATTERN = re.compile(r'@(\w(?:[\w.-]*\w)?)')
+FETCH_REQUESTS = {"GET_USER_LIST": "FETCH_USER_LIST", "GET_HISTORY": "FETCH_HISTORY", "GET_ROOM_LIST": "FETCH_ROOM_LIST", "GET_MENTIONS": "FETCH_MENTIONS", "SEARCH": "SEARCH"}
+CUSTOM_REQUESTS = {"CHANGE_USERNAME": "CHANGE_USERNAME", "JOIN_ROOM": "JOIN_ROOM", "LEAVE_ROOM": "LEAVE_ROOM"}
+
+# Wire formats a client can ask for in its JOIN. The JOIN itself and anything
+# sent before the server accepts it are always JSON lines.
+FRAMING_JSON = "json"
+FRAMING_BINARY = "binary"
+FRAMINGS = (FRAMING_JSON, FRAMING_BINARY)
+
+def valid_room_name(name):
+    return isinstance(name, str) and bool(ROOM_NAME_PATTERN.match(name))
+
+
+def valid_username(name):
+    return isinstance(name, str) and bool(USERNAME_PATTERN.match(name))
+
 
 def createMessage(sender, type=MSG_MESSAGE, content='<Empty>', timestamp=None):
 
@@ -34,3 +66,271 @@ def deserialize(data):
     except (json.JSONDecodeError, UnicodeDecodeError) as e:
         print("failed to deserialize: ", e)
         return None
+
+
+class Message:
+    # One message on its way through the server. It is encoded at most once
+    # per format and the same object is stored, kept in the replay ring and
+    # fanned out, so the hot path never serializes it again. Treat it as
+    # read-only once it exists.
+
+    __slots__ = ('_fields', '_line', '_frame')
+
+    def __init__(self, fields=None, line=None):
+        self._fields = fields
+        self._line = line
+        self._frame = None
+
+    @classmethod
+    def from_line(cls, line):
+        return cls(line=line)
+
+    @property
+    def fields(self):
+        if self._fields is None:
+            self._fields = json.loads(self._line)
+        return self._fields
+
+    @property
+    def line(self):
+        # JSON line, used on the wire for JSON clients and in the history files
+        if self._line is None:
+            self._line = serialize(self._fields)
+        return self._line
+
+    @property
+    def frame(self):
+        # (binary frame, name ids it refers to)
+        if self._frame is None:
+            self._frame = pack_frame(self.fields)
+        return self._frame
+
+    def get(self, key, default=None):
+        return self.fields.get(key, default)
+
+
+# Binary framing
+#
+# frame  = length (u32) + body
+# body   = type code (u8), flags (u8), timestamp ms (i64), sender id (u32),
+#          room id (u32), seq (i64), content length (u32), content,
+#          extra fields as JSON
+#
+# Sender and room names are sent once per connection in a definition frame
+# (code 255, id, name) and referred to by id after that.
+
+TYPE_CODES = {
+    MSG_JOIN: 1, MSG_LEAVE: 2, MSG_MESSAGE: 3, MSG_USERLIST: 4, MSG_ERROR: 5,
+    MSG_SUCCESS: 6, MSG_HISTORY: 7, MSG_USER_JOINED: 8, MSG_USER_LEFT: 9,
+    MSG_USER_RENAMED: 10, MSG_ROOM_LIST: 11,
+    "FETCH_USER_LIST": 12, "FETCH_HISTORY": 13, "FETCH_ROOM_LIST": 14,
+    "CHANGE_USERNAME": 15, "JOIN_ROOM": 16, "LEAVE_ROOM": 17,
+    MSG_PING: 18, MSG_PONG: 19, MSG_MENTION: 20, "FETCH_MENTIONS": 21, "SEARCH": 22,
+}
+CODE_TYPES = {code: type for type, code in TYPE_CODES.items()}
+NAME_CODE = 255
+
+FLAG_JSON_CONTENT = 1
+FLAG_TIMESTAMP = 2
+FLAG_SEQ = 4
+
+FRAME_LENGTH = struct.Struct('!I')
+FRAME_HEADER = struct.Struct('!BBqIIq')
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+CORE_KEYS = frozenset(('type', 'sender', 'content', 'timestamp', 'seq', 'room'))
+
+# Only names the server vouches for get an id: itself, rooms and users who
+# joined one. Anything else a client put in a message is sent inline. Ids
+# are never reused, so the table is capped rather than pruned.
+MAX_NAMES = 65536
+name_ids = {None: 0, "Server": 1}
+names = [None, "Server"]
+
+
+def intern_name(name):
+    if name not in name_ids and len(names) < MAX_NAMES:
+        name_ids[name] = len(names)
+        names.append(name)
+
+
+def name_frame(name_id):
+    name = names[name_id]
+    body = bytes((NAME_CODE,)) + FRAME_LENGTH.pack(name_id) + name.encode('utf-8')
+    return FRAME_LENGTH.pack(len(body)) + body
+
+
+def interned(value, extras, key):
+    if value is None or isinstance(value, str):
+        name_id = name_ids.get(value)
+        if name_id is not None:
+            return name_id
+    extras[key] = value
+    return 0
+
+
+def pack_frame(message):
+    # Returns the frame and the name ids it refers to
+    extras = {}
+    if not message.keys() <= CORE_KEYS:
+        extras = {key: value for key, value in message.items() if key not in CORE_KEYS}
+    flags = 0
+
+    msg_type = message.get('type')
+    code = TYPE_CODES.get(msg_type, 0)
+    if code == 0 and msg_type is not None:
+        extras['type'] = msg_type
+
+    sender_id = interned(message.get('sender'), extras, 'sender')
+    room_id = interned(message.get('room'), extras, 'room')
+
+    content = message.get('content')
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    else:
+        content = json.dumps(content).encode('utf-8')
+        flags |= FLAG_JSON_CONTENT
+
+    timestamp_ms = 0
+    timestamp = message.get('timestamp')
+    if timestamp is not None:
+        try:
+            timestamp_ms = round(datetime.fromisoformat(timestamp).timestamp() * 1000)
+            flags |= FLAG_TIMESTAMP
+        except (TypeError, ValueError, OverflowError, OSError):
+            extras['timestamp'] = timestamp
+
+    seq = message.get('seq')
+    if isinstance(seq, int) and not isinstance(seq, bool):
+        flags |= FLAG_SEQ
+    else:
+        if seq is not None:
+            extras['seq'] = seq
+        seq = 0
+
+    body = b''.join((
+        FRAME_HEADER.pack(code, flags, timestamp_ms, sender_id, room_id, seq),
+        FRAME_LENGTH.pack(len(content)),
+        content,
+        json.dumps(extras, separators=(',', ':')).encode('utf-8') if extras else b''
+    ))
+    return FRAME_LENGTH.pack(len(body)) + body, (sender_id, room_id)
+
+
+def unpack_frame(body, known_names):
+    # Returns the message, or None for a name definition
+    try:
+        if body[0] == NAME_CODE:
+            (name_id,) = FRAME_LENGTH.unpack_from(body, 1)
+            if name_id in known_names or len(known_names) < MAX_NAMES:
+                known_names[name_id] = body[1 + FRAME_LENGTH.size:].decode('utf-8')
+            return None
+
+        code, flags, timestamp_ms, sender_id, room_id, seq = FRAME_HEADER.unpack_from(body)
+        offset = FRAME_HEADER.size
+        (length,) = FRAME_LENGTH.unpack_from(body, offset)
+        offset += FRAME_LENGTH.size
+        content = body[offset:offset + length].decode('utf-8')
+        if flags & FLAG_JSON_CONTENT:
+            content = json.loads(content)
+
+        message = {"type": CODE_TYPES.get(code), "sender": known_names.get(sender_id), "content": content}
+        if flags & FLAG_TIMESTAMP:
+            message['timestamp'] = datetime.fromtimestamp(timestamp_ms / 1000).isoformat()
+        if room_id:
+            message['room'] = known_names.get(room_id)
+        if flags & FLAG_SEQ:
+            message['seq'] = seq
+        extras = body[offset + length:]
+        if extras:
+            extras = json.loads(extras)
+            if not isinstance(extras, dict):
+                raise ValueError("extra fields are not an object")
+            message.update(extras)
+        return message
+    except (struct.error, IndexError, ValueError, OverflowError, OSError) as e:
+        print("failed to unpack frame: ", e)
+        return {}
+
+
+_last_lines = (None, b'', frozenset())
+
+
+def frames_from_lines(data):
+    # Re-pack one or more JSON lines as binary frames. A broadcast hands the
+    # same bytes object to every member, so the last result is reused.
+    global _last_lines
+    if _last_lines[0] is data:
+        return _last_lines[1], _last_lines[2]
+
+    frames = []
+    name_ids = set()
+    for line in data.splitlines():
+        message = deserialize(line)
+        if not message:
+            continue
+        frame, ids = pack_frame(message)
+        frames.append(frame)
+        name_ids.update(ids)
+
+    _last_lines = (data, b''.join(frames), frozenset(name_ids))
+    return _last_lines[1], _last_lines[2]
+
+
+class FrameTooLarge(ValueError):
+
+    def __init__(self, size):
+        super().__init__(f"Frame of {size} bytes is too large")
+        self.size = size
+
+
+class FrameReader:
+    # Reads binary frames off a stream, remembering the names the other side
+    # has defined
+
+    def __init__(self, reader, max_size=MAX_FRAME_SIZE):
+        self.reader = reader
+        self.max_size = max_size
+        self.names = {0: None}
+
+    async def read_raw(self, head=None):
+        # The body of the next frame, undecoded. Oversized frames are read
+        # past in small pieces and never held in memory.
+        if head is None:
+            head = await self.reader.readexactly(FRAME_LENGTH.size)
+        (length,) = FRAME_LENGTH.unpack(head)
+        if length > self.max_size:
+            remaining = length
+            while remaining:
+                remaining -= len(await self.reader.readexactly(min(remaining, 65536)))
+            raise FrameTooLarge(length)
+        return await self.reader.readexactly(length)
+
+    def decode(self, body):
+        # The message, or None if the frame only defined a name
+        return unpack_frame(body, self.names)
+
+    async def read(self, head=None):
+        while True:
+            message = self.decode(await self.read_raw(head))
+            head = None
+            if message is not None:
+                return message
+
+
+class FrameWriter:
+    # Packs messages for one connection, defining each name the first time
+
+    def __init__(self):
+        self.known = {0}
+
+    def pack(self, message):
+        # Our own name and room are safe to give ids to
+        for key in ('sender', 'room'):
+            if isinstance(message.get(key), str):
+                intern_name(message[key])
+        frame, ids = pack_frame(message)
+        new_ids = [name_id for name_id in ids if name_id not in self.known]
+        if not new_ids:
+            return frame
+        self.known.update(new_ids)
+        return b''.join(name_frame(name_id) for name_id in new_ids) + frame
@@ -1,63 +1,73 @@
 import asyncio
+import time
 from protocal import *
 from server_requests import handle_fetch_request
+from server_outbound import ClientConnection, heartbeat
+from server_settings import HEARTBEAT_INTERVAL_S, HEARTBEAT_TIMEOUT_S, MAX_FRAME_BYTES, MAX_MESSAGE_CHARS
+from server_rooms import Rooms, RoomLimitReached
+from server_metrics import metrics, format_stats, report_metrics
+from server_limits import Admission
 
 clients = {}
 
+HISTORY_DIR = "chat_history"
 HISTORY_FILE = "chat_history.txt"
 
-
-async def save_message(message):
-    try:
-        with open(HISTORY_FILE, 'a') as f:
-            f.write(json.dumps(message) + '\n')
-    except Exception as e:
-        print(f"Error saving message to history: {e}")
-
-
-async def send_history(writer, username):
-    try:
-        with open(HISTORY_FILE, 'r') as f:
-            for line in f:
-                msg = json.loads(line.strip())
-                data = serialize(msg)
-                writer.write(data)
-                await writer.drain()
-        print(f"Sent chat history to {username}")
-    except FileNotFoundError:
-        print(f"No history file found, starting fresh")
-    except Exception as e:
-        print(f"Error sending history to {username}: {e}")
+rooms = None
+bus = None
+admission = None
 
 
-async def broadcast(message, exclude=None):
-    data = serialize(message)
+async def broadcast(message, exclude=None, room=None):
+    if room is not None:
+        room.broadcast(message, exclude=exclude)
+        return
 
-    clients_snapshot = list(clients.items())
+    # In multi-process mode the hub has no clients of its own, the workers do
+    if bus is not None:
+        bus.announce(None, message, exclude=exclude)
+        return
 
-    for username, (reader, writer) in clients_snapshot:
+    # Server wide announcements go to everyone
+    message = Message(message)
+    for username, conn in list(clients.items()):
         if username == exclude:
             continue
+        conn.send(message)
+        metrics.count("messages_out")
 
-        try:
-            writer.write(data)
-            await writer.drain()
-        except Exception as e:
-            print(f"Error sending to {username}: {e}")
+
+async def reject(writer, content, retry_after=None):
+    # Handshake errors go out as a JSON line before any framing is agreed
+    error_msg = createMessage(sender="Server", type=MSG_ERROR, content=content)
+    if retry_after is not None:
+        error_msg['retry_after'] = retry_after
+    writer.write(serialize(error_msg))
+    await writer.drain()
+    writer.close()
+    await writer.wait_closed()
 
 
 async def handle_client(reader, writer):
     username = None
+    conn = None
     addr = writer.get_extra_info('peername')
     authenticated = False
+    claimed = False
+    admitted = None
 
     try:
         print(f"New connection")
-        data = await reader.readline()
+        try:
+            data = await asyncio.wait_for(reader.readline(), HEARTBEAT_TIMEOUT_S or None)
+        except asyncio.TimeoutError:
+            print(f"Client never sent JOIN, closing")
+            return
         if not data:
             print(f"Client disconnected before sending JOIN")
             return
 
+        join_started = time.perf_counter()
         join_msg = deserialize(data)
         if not join_msg or join_msg.get('type') != MSG_JOIN:
             print(f"Invalid JOIN message")
@@ -67,74 +77,105 @@ async def handle_client(reader, writer):
         if not username:
             print(f"No username provided")
             return
+        if not valid_username(username):
+            print(f"Invalid username {username!r}, rejecting connection")
+            await reject(writer, USERNAME_RULES)
+            return
+
+        room_name = join_msg.get('room') or DEFAULT_ROOM
+        if not valid_room_name(room_name):
+            room_name = DEFAULT_ROOM
+
+        last_seen_seq = join_msg.get('last_seen_seq')
+        if not isinstance(last_seen_seq, int) or isinstance(last_seen_seq, bool):
+            last_seen_seq = None
+
+        if not await admission.admit():
+            retry_after = admission.retry_after()
+            metrics.count("joins_refused")
+            print(f"Too many joins in progress, asking {username} to retry in {retry_after}s")
+            await reject(writer, f"Server is busy, try again in {retry_after}s", retry_after)
+            return
+        admitted = time.perf_counter()
 
-        if username in clients:
+        if username in clients or not await rooms.claim_username(username):
             print(f"Username '{username}' is already in use, rejecting connection")
-            error_msg = createMessage(
-                sender="Server",
-                type=MSG_ERROR,
-                content=f"Username '{username}' is already taken. Please choose a different username."
-            )
-            writer.write(serialize(error_msg))
-            await writer.drain()
-            writer.close()
-            await writer.wait_closed()
+            await reject(writer, f"Username '{username}' is already taken. Please choose a different username.")
             return
+        claimed = True
+
+        framing = join_msg.get('framing')
+        if framing not in FRAMINGS:
+            framing = FRAMING_JSON
 
         print(f"{username} joined")
 
-        clients[username] = (reader, writer)
-        authenticated = True
+        conn = ClientConnection(reader, writer, username, framing=framing)
+        conn.start()
 
         success_msg = createMessage(
             sender="Server",
             type=MSG_SUCCESS,
             content="Connected successfully"
         )
-        writer.write(serialize(success_msg))
-        await writer.drain()
-
-        await send_history(writer, username)
-
-        join_broadcast = createMessage(
-            sender="Server",
-            type=MSG_JOIN,
-            content=f"{username} has joined the chat"
-        )
-        await save_message(join_broadcast)
-        await broadcast(join_broadcast)
-
-        user_list_msg = createMessage(
-            sender="Server",
-            type=MSG_USERLIST,
-            content=list(clients.keys())
-        )
-        await broadcast(user_list_msg)
+        # Lets the client notice a dead server instead of waiting forever
+        success_msg['heartbeat'] = {"interval": HEARTBEAT_INTERVAL_S, "timeout": HEARTBEAT_TIMEOUT_S}
+        success_msg['limits'] = {"max_message_chars": MAX_MESSAGE_CHARS}
+        try:
+            room = await rooms.get(room_name)
+            replayed = await room.join(username, conn, success_msg, last_seen_seq)
+        except RoomLimitReached:
+            # No room for that room right now, start out in the default one
+            room = await rooms.get(DEFAULT_ROOM)
+            replayed = await room.join(username, conn, success_msg)
+        if replayed:
+            print(f"Sent #{room.name} history to {username}")
+
+        clients[username] = conn
+        authenticated = True
+        admission.release(admitted)
+        admitted = None
+        metrics.count("joins")
+        metrics.observe("join", time.perf_counter() - join_started)
 
         while True:
-            data = await reader.readline()
-            if not data:
+            msg = await conn.read_message()
+            if msg is None:
                 break
-
-            msg = deserialize(data)
             if not msg:
                 continue
 
+            metrics.count("messages_in")
             msg_type = msg.get('type')
 
             if msg_type == MSG_MESSAGE:
-                print(f"{username}: {msg.get('content')}")
-                await save_message(msg)
-                await broadcast(msg)
+                content = msg.get('content')
+                if not isinstance(content, str) or len(content) > MAX_MESSAGE_CHARS:
+                    conn.refuse(f"Messages can be at most {MAX_MESSAGE_CHARS} characters")
+                    continue
+                room = rooms.get_open(msg.get('room') or DEFAULT_ROOM)
+                if room is None or username not in room.members:
+                    error_msg = createMessage(sender="Server", type=MSG_ERROR, content="You are not in that room")
+                    conn.send_control(Message(error_msg))
+                    continue
+                print(f"[#{room.name}] {username}: {msg.get('content')}")
+                room.publish(msg)
 
             elif msg_type == MSG_LEAVE:
                 print(f"{username} is leaving")
                 break
+
+            elif msg_type == MSG_PING:
+                conn.send_control(Message(createMessage(sender="Server", type=MSG_PONG, content=msg.get('content'))))
+
+            elif msg_type == MSG_PONG:
+                continue
             
             elif msg_type in FETCH_REQUESTS.values() or msg_type in CUSTOM_REQUESTS.values():
-                result = await handle_fetch_request(clients, msg, username, writer, broadcast)
+                result = await handle_fetch_request(clients, msg, username, conn, rooms)
                 if msg_type == CUSTOM_REQUESTS["CHANGE_USERNAME"] and result != True and result != False:
                     username = result
+                    conn.username = username
 
 
     except asyncio.CancelledError:
@@ -142,40 +183,72 @@ async def handle_client(reader, writer):
     except Exception as e:
         print(f"Error with client {username}: {e}")
     finally:
-        if authenticated and username and username in clients:
-            del clients[username]
-            print(f"{username} disconnected")
-
-            leave_msg = createMessage(
-                sender="Server",
-                type=MSG_LEAVE,
-                content=f"{username} has left the chat"
-            )
-            await save_message(leave_msg)
-            await broadcast(leave_msg)
-
-            user_list_msg = createMessage(
-                sender="Server",
-                type=MSG_USERLIST,
-                content=list(clients.keys())
-            )
-            await broadcast(user_list_msg)
-
+        if admitted is not None:
+            admission.release(admitted)
+
+        if conn:
+            if clients.get(username) is conn:
+                del clients[username]
+            for room_name in list(conn.rooms):
+                room = rooms.get_open(room_name)
+                if room:
+                    room.remove_member(username)
+            if authenticated:
+                print(f"{username} disconnected")
+            await conn.close()
+        else:
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except Exception as e:
+                print(f"Error closing connection: {e}")
+
+        if claimed:
+            rooms.release_username(username)
+
+
+def read_console(loop, commands):
+    # Fallback for platforms without add_reader on stdin (Windows)
+    while True:
         try:
-            writer.close()
-            await writer.wait_closed()
-        except Exception as e:
-            print(f"Error closing connection: {e}")
+            line = input()
+        except EOFError:
+            break
+        try:
+            loop.call_soon_threadsafe(commands.put_nowait, line)
+        except RuntimeError:
+            break
+
+
+def watch_console(loop, commands):
+    import sys
+    import threading
+
+    def on_stdin():
+        line = sys.stdin.readline()
+        if not line:
+            loop.remove_reader(sys.stdin.fileno())
+            return
+        commands.put_nowait(line)
+
+    # Reading stdin from the loop keeps shutdown from waiting on a blocked input() call
+    try:
+        loop.add_reader(sys.stdin.fileno(), on_stdin)
+    except (NotImplementedError, ValueError, OSError, AttributeError):
+        threading.Thread(target=read_console, args=(loop, commands), daemon=True).start()
 
 
 async def console_input():
-    loop = asyncio.get_event_loop()
+    loop = asyncio.get_running_loop()
+    commands = asyncio.Queue()
+    watch_console(loop, commands)
     while True:
         try:
-            cmd = await loop.run_in_executor(None, input)
+            cmd = await commands.get()
             if cmd.strip().lower() == "clear":
                 try:
-                    open(HISTORY_FILE, 'w').close()
+                    for room in list(rooms.rooms.values()):
+                        await room.history.clear()
                     print("Chat history cleared on server")
 
                     clear_msg = createMessage(
@@ -186,23 +259,133 @@ async def console_input():
                     await broadcast(clear_msg)
                 except Exception as e:
                     print(f"Error clearing history: {e}")
+            elif cmd.strip().lower() == "stats":
+                print(format_stats(metrics.snapshot(clients)))
             elif cmd.strip().lower() == "help":
                 print("\nServer Commands:")
                 print("  clear - Clear chat history and notify all users")
+                print("  stats - Show throughput, queue depths and latency histograms")
                 print("  help  - Show this help message")
                 print()
         except Exception as e:
             print(f"Console error: {e}")
             break
 
+def parse_args():
+    import argparse
+    import os
+    parser = argparse.ArgumentParser(description="MessageFy server")
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WORKERS', 0)),
+                        help="Accept connections in N worker processes sharing the port")
+    parser.add_argument('--bus', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def add_shutdown_handler():
+    try:
+        import signal
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    except (NotImplementedError, AttributeError):
+        pass
+
+
+async def run_worker(bus_path, host, port):
+    from server_bus import RemoteRooms
+    global rooms, admission
+    admission = Admission()
+    rooms = RemoteRooms(clients)
+    await rooms.connect(bus_path)
+    rooms.on_lost = asyncio.current_task().cancel
+
+    server = await asyncio.start_server(handle_client, host, port, reuse_port=True, limit=MAX_FRAME_BYTES)
+    add_shutdown_handler()
+    asyncio.create_task(report_metrics(clients))
+    asyncio.create_task(heartbeat(clients))
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await rooms.close()
+
+
+async def run_hub(workers, host, port):
+    import os
+    import sys
+    import tempfile
+    from server_bus import BusHub
+    global bus
+
+    bus_path = os.path.join(tempfile.gettempdir(), f"messagefy-{port}-{os.getpid()}.sock")
+    bus = BusHub(rooms)
+    await bus.start(bus_path)
+
+    processes = []
+    for _ in range(workers):
+        processes.append(await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), '--bus', bus_path,
+            stdin=asyncio.subprocess.DEVNULL,
+            env=dict(os.environ, PORT=str(port))
+        ))
+
+    print(f"MessageFy Server started on {host}:{port} with {workers} workers")
+    print("Waiting for connections...")
+    print("Type 'help' for server commands\n")
+
+    add_shutdown_handler()
+    asyncio.create_task(console_input())
+    asyncio.create_task(report_metrics(clients))
+
+    try:
+        await asyncio.gather(*(process.wait() for process in processes))
+        print("All workers exited")
+    finally:
+        for process in processes:
+            if process.returncode is None:
+                process.terminate()
+        for process in processes:
+            await process.wait()
+        await bus.close()
+        try:
+            os.unlink(bus_path)
+        except OSError:
+            pass
+
+
 async def main():
     import os
+    import socket
+    global rooms, admission
     HOST = '0.0.0.0'
     PORT = int(os.environ.get('PORT', 5000))
+    args = parse_args()
+
+    if (args.workers > 1 or args.bus) and not (hasattr(socket, 'SO_REUSEPORT') and hasattr(socket, 'AF_UNIX')):
+        print("Multiple workers need SO_REUSEPORT and Unix sockets, starting a single process server")
+        args.workers = 0
+        args.bus = None
+
+    if args.bus:
+        await run_worker(args.bus, HOST, PORT)
+        return
+
+    rooms = Rooms(HISTORY_DIR, legacy_file=HISTORY_FILE, clients=clients)
+    await rooms.get(DEFAULT_ROOM)
+
+    admission = Admission()
+    if args.workers > 1:
+        try:
+            await run_hub(args.workers, HOST, PORT)
+        finally:
+            await rooms.close()
+            print("Chat history flushed")
+        return
+
     server = await asyncio.start_server(
         handle_client,
         HOST,
-        PORT
+        PORT,
+        limit=MAX_FRAME_BYTES
     )
 
     addr = server.sockets[0].getsockname()
@@ -210,10 +393,18 @@ async def main():
     print("Waiting for connections...")
     print("Type 'help' for server commands\n")
 
+    add_shutdown_handler()
+
     asyncio.create_task(console_input())
+    asyncio.create_task(report_metrics(clients))
+    asyncio.create_task(heartbeat(clients))
 
-    async with server:
-        await server.serve_forever()
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await rooms.close()
+        print("Chat history flushed")
 
 
 if __name__ == "__main__":
@@ -221,3 +412,5 @@ if __name__ == "__main__":
         asyncio.run(main())
     except KeyboardInterrupt:
         print("\nServer stopped by user")
+    except asyncio.CancelledError:
+        print("\nServer stopped")
@@ -0,0 +1,447 @@
+import asyncio
+import json
+import time
+from protocal import *
+from server_presence import Presence
+from server_metrics import metrics
+from server_rooms import deliver, join_notice, leave_notice, RoomLimitReached
+from server_mentions import mentioned_users, mention_event
+
+# Multi-process mode. The parent process runs the BusHub, which owns
+# usernames, seqs, history and presence. Each worker accepts clients on the
+# shared port and talks to the hub over a Unix socket, so a message from a
+# client on worker A reaches worker B through exactly one extra hop.
+#
+# Frames are one JSON header line, optionally followed by `size` raw bytes
+# (already serialized chat lines, passed through untouched).
+
+# Requests that change state are handled in the order they arrive, other
+# requests only read and run alongside them
+ORDERED_REQUESTS = ("claim", "join")
+
+# Paged reads, named after the Room method that serves them, with its
+# arguments in order. Replies carry the raw lines.
+PAGE_OPS = {
+    "fetch_history": ("before", "after", "before_time", "limit"),
+    "fetch_mentions": ("username", "after", "limit"),
+    "search": ("query", "before", "limit"),
+}
+
+
+def encode_frame(header, data=None):
+    if data is not None:
+        header['size'] = len(data)
+        return serialize(header) + data
+    return serialize(header)
+
+
+async def read_frame(reader):
+    line = await reader.readline()
+    if not line:
+        return None, None
+    header = json.loads(line)
+    data = None
+    if 'size' in header:
+        data = await reader.readexactly(header['size'])
+    return header, data
+
+
+class BusHub:
+
+    def __init__(self, rooms):
+        self.rooms = rooms
+        self.workers = {}
+        self.usernames = {}
+        self.memberships = {}
+        self.next_worker = 1
+        self.server = None
+        self.tasks = set()
+
+    async def start(self, path):
+        self.server = await asyncio.start_unix_server(self.handle_worker, path, limit=2 ** 24)
+
+    def send(self, worker_id, header, data=None):
+        writer = self.workers.get(worker_id)
+        if writer:
+            writer.write(encode_frame(header, data))
+
+    def fan_out(self, header, data=None):
+        frame = encode_frame(header, data)
+        for writer in list(self.workers.values()):
+            writer.write(frame)
+
+    def announce(self, room_name, message, exclude=None):
+        self.fan_out({"op": "broadcast", "room": room_name, "exclude": exclude}, serialize(message))
+
+    def publish(self, room, message):
+        message['room'] = room.name
+        users = mentioned_users(message)
+        self.fan_out({"op": "deliver", "room": room.name}, room.history.append(message, users).line)
+        for username in users:
+            # Only the worker the mentioned user is connected to hears about it
+            worker_id = self.usernames.get(username)
+            if worker_id:
+                self.send(worker_id, {"op": "direct", "username": username}, serialize(mention_event(message, room.name, message['seq'])))
+
+    async def handle_worker(self, reader, writer):
+        worker_id = self.next_worker
+        self.next_worker += 1
+        self.workers[worker_id] = writer
+        self.memberships[worker_id] = set()
+        print(f"Worker {worker_id} connected to the bus")
+
+        try:
+            while True:
+                header, data = await read_frame(reader)
+                if header is None:
+                    break
+                if header.get('req') and header.get('op') not in ORDERED_REQUESTS:
+                    # A slow page read doesn't hold up everything behind it
+                    task = asyncio.create_task(self.run(worker_id, header, data))
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+                else:
+                    await self.run(worker_id, header, data)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            print(f"Worker {worker_id} left the bus")
+            del self.workers[worker_id]
+            for room_name, username in self.memberships.pop(worker_id):
+                room = self.rooms.get_open(room_name)
+                if room:
+                    self.leave(room, username)
+            for username, owner in list(self.usernames.items()):
+                if owner == worker_id:
+                    del self.usernames[username]
+            writer.close()
+
+    async def run(self, worker_id, header, data):
+        try:
+            await self.handle(worker_id, header, data)
+        except RoomLimitReached as e:
+            if header.get('req'):
+                self.send(worker_id, {"op": "reply", "req": header['req'], "error": str(e), "room_limit": True})
+        except Exception as e:
+            print(f"Bus error handling {header.get('op')} from worker {worker_id}: {e}")
+            if header.get('req'):
+                self.send(worker_id, {"op": "reply", "req": header['req'], "error": str(e)})
+
+    def open_room(self, name):
+        # Requests other than join only come for rooms the client is in
+        room = self.rooms.get_open(name)
+        if room is None:
+            raise RuntimeError(f"#{name} is not open")
+        return room
+
+    def leave(self, room, username):
+        self.publish(room, leave_notice(username, room.name))
+        left_msg = room.presence.left(username)
+        if left_msg:
+            self.announce(room.name, left_msg)
+        room.check_idle()
+
+    async def handle(self, worker_id, header, data):
+        op = header.get('op')
+        req = header.get('req')
+
+        if op == "claim":
+            username = header['username']
+            ok = username not in self.usernames
+            if ok:
+                self.usernames[username] = worker_id
+            self.send(worker_id, {"op": "reply", "req": req, "ok": ok})
+
+        elif op == "release":
+            if self.usernames.get(header['username']) == worker_id:
+                del self.usernames[header['username']]
+
+        elif op == "join":
+            room = await self.rooms.get(header['room'])
+            username = header['username']
+            gap = await room.join_gap(header.get('last_seen_seq'))
+
+            # Same order as Room.add_member: replay first, then the join
+            # notice and presence delta everyone else sees
+            chunks = room.history.replay_chunks(gap) if gap is not None else None
+            resync = chunks is None
+            if resync:
+                chunks = room.history.replay_chunks()
+            joined_msg = room.presence.joined(username)
+            self.memberships[worker_id].add((room.name, username))
+
+            self.send(worker_id, {
+                "op": "joined",
+                "req": req,
+                "room": room.name,
+                "username": username,
+                "resync": resync,
+                "last_seq": room.history.last_seq,
+                "users": room.presence.users,
+                "version": room.presence.version,
+                "chunks": [sum(len(message.line) for message in chunk) for chunk in chunks],
+            }, b''.join(message.line for chunk in chunks for message in chunk))
+            self.publish(room, join_notice(username, room.name))
+            self.announce(room.name, joined_msg, exclude=username)
+
+        elif op == "leave":
+            room = self.rooms.get_open(header['room'])
+            membership = (header['room'], header['username'])
+            if room and membership in self.memberships[worker_id]:
+                self.memberships[worker_id].discard(membership)
+                self.leave(room, header['username'])
+
+        elif op == "rename_member":
+            room = self.rooms.get_open(header['room'])
+            old_name, new_name = header['old'], header['new']
+            if room and (room.name, old_name) in self.memberships[worker_id]:
+                self.memberships[worker_id].discard((room.name, old_name))
+                self.memberships[worker_id].add((room.name, new_name))
+                self.announce(room.name, room.presence.renamed(old_name, new_name))
+
+        elif op == "publish":
+            # Workers only publish to rooms their client is in, which are open
+            room = self.rooms.get_open(header['room'])
+            if room:
+                self.publish(room, json.loads(data))
+
+        elif op == "announce":
+            self.fan_out({"op": "broadcast", "room": header.get('room'), "exclude": header.get('exclude')}, data)
+
+        elif op in PAGE_OPS:
+            room = self.open_room(header['room'])
+            lines, has_more = await getattr(room, op)(*(header.get(key) for key in PAGE_OPS[op]))
+            self.send(worker_id, {"op": "reply", "req": req, "has_more": has_more}, b''.join(lines))
+
+        elif op == "room_list":
+            self.send(worker_id, {"op": "reply", "req": req, "rooms": await self.rooms.room_list()})
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+        for writer in list(self.workers.values()):
+            writer.close()
+
+
+class RemoteRoom:
+    # Worker side stand-in for Room. Members are the clients connected to
+    # this worker, everything else goes through the hub. It is dropped once
+    # none of them are left, like an idle Room.
+
+    def __init__(self, name, bus):
+        self.name = name
+        self.bus = bus
+        self.members = {}
+        self.presence = Presence(name)
+        self.joining = 0
+
+    def deliver(self, message, exclude=None, control=False):
+        deliver(self.members, message, exclude, control)
+
+    def broadcast(self, message, exclude=None):
+        message['room'] = self.name
+        self.bus.send({"op": "announce", "room": self.name, "exclude": exclude}, serialize(message))
+
+    def publish(self, message):
+        message['room'] = self.name
+        self.bus.send({"op": "publish", "room": self.name}, serialize(message))
+
+    async def join(self, username, conn, welcome, last_seen_seq=None):
+        self.joining += 1
+        try:
+            header, data = await self.bus.request({
+                "op": "join",
+                "room": self.name,
+                "username": username,
+                "last_seen_seq": last_seen_seq
+            }, context=(conn, welcome))
+        finally:
+            self.joining -= 1
+            self.check_idle()
+        return len(header.get('chunks', []))
+
+    def check_idle(self):
+        if not self.members and not self.joining:
+            self.bus.forget(self)
+
+    def finish_join(self, header, data, conn, welcome):
+        # Runs inside the bus read loop, so nothing for this room can be
+        # delivered between the replay and the member being registered
+        username = header['username']
+        self.members[username] = conn
+        conn.rooms.add(self.name)
+        self.presence.reset(header['users'], header['version'])
+
+        welcome['room'] = self.name
+        welcome['resync'] = header['resync']
+        welcome['last_seq'] = header['last_seq']
+        started = time.perf_counter()
+        conn.send_control(Message(welcome))
+        # Same chunks as the hub's replay, so control traffic can still get
+        # in between them
+        offset = 0
+        for size in header.get('chunks', []):
+            conn.send_bulk(data[offset:offset + size])
+            offset += size
+        metrics.observe("replay", time.perf_counter() - started)
+        conn.send_bulk(Message(self.presence.full_list()))
+
+    def remove_member(self, username):
+        conn = self.members.pop(username, None)
+        if conn is None:
+            return False
+        conn.rooms.discard(self.name)
+        self.bus.send({"op": "leave", "room": self.name, "username": username})
+        self.check_idle()
+        return True
+
+    def rename_member(self, old_name, new_name):
+        if old_name not in self.members:
+            return
+        self.members[new_name] = self.members.pop(old_name)
+        self.bus.send({"op": "rename_member", "room": self.name, "old": old_name, "new": new_name})
+
+    async def page(self, op, *args):
+        header, data = await self.bus.request(dict(zip(PAGE_OPS[op], args), op=op, room=self.name))
+        return data.splitlines(keepends=True) if data else [], header.get('has_more', False)
+
+    async def fetch_history(self, before=None, after=None, before_time=None, limit=None):
+        return await self.page("fetch_history", before, after, before_time, limit)
+
+    async def fetch_mentions(self, username, after=None, limit=None):
+        return await self.page("fetch_mentions", username, after, limit)
+
+    async def search(self, query, before=None, limit=None):
+        return await self.page("search", query, before, limit)
+
+
+class RemoteRooms:
+    # Worker side stand-in for Rooms, backed by a connection to the hub
+
+    def __init__(self, clients):
+        self.clients = clients
+        self.rooms = {}
+        self.pending = {}
+        self.request_counter = 0
+        self.reader = None
+        self.writer = None
+        self.read_task = None
+        self.on_lost = None
+
+    async def connect(self, path):
+        self.reader, self.writer = await asyncio.open_unix_connection(path, limit=2 ** 24)
+        self.read_task = asyncio.create_task(self._read_loop())
+
+    def send(self, header, data=None):
+        self.writer.write(encode_frame(header, data))
+
+    async def request(self, header, context=None):
+        self.request_counter += 1
+        req = self.request_counter
+        future = asyncio.get_running_loop().create_future()
+        self.pending[req] = (future, context)
+        header['req'] = req
+        self.send(header)
+        try:
+            return await future
+        finally:
+            self.pending.pop(req, None)
+
+    def local(self, name):
+        room = self.rooms.get(name)
+        if room is None:
+            room = RemoteRoom(name, self)
+            self.rooms[name] = room
+        return room
+
+    async def get(self, name):
+        return self.local(name)
+
+    def forget(self, room):
+        if self.rooms.get(room.name) is room:
+            del self.rooms[room.name]
+
+    def get_open(self, name):
+        return self.rooms.get(name)
+
+    async def claim_username(self, username):
+        header, _ = await self.request({"op": "claim", "username": username})
+        return header.get('ok', False)
+
+    def release_username(self, username):
+        self.send({"op": "release", "username": username})
+
+    async def room_list(self):
+        header, _ = await self.request({"op": "room_list"})
+        return header.get('rooms', [])
+
+    def announce(self, message, exclude=None):
+        self.send({"op": "announce", "room": None, "exclude": exclude}, serialize(message))
+
+    async def _read_loop(self):
+        try:
+            while True:
+                header, data = await read_frame(self.reader)
+                if header is None:
+                    break
+                self._dispatch(header, data)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            print(f"Lost connection to the bus: {e}")
+        except asyncio.CancelledError:
+            return
+        print("Bus connection closed")
+        if self.on_lost:
+            self.on_lost()
+
+    def _dispatch(self, header, data):
+        op = header.get('op')
+
+        if op == "deliver":
+            # Rooms with nobody on this worker are not kept here at all
+            room = self.rooms.get(header['room'])
+            if room:
+                room.deliver(Message.from_line(data))
+
+        elif op == "broadcast":
+            room_name = header.get('room')
+            exclude = header.get('exclude')
+            message = Message.from_line(data)
+            if room_name is None:
+                for username, conn in list(self.clients.items()):
+                    if username != exclude:
+                        conn.send(message)
+                return
+            room = self.rooms.get(room_name)
+            if room is None:
+                return
+            presence = message.get('type') in PRESENCE_EVENTS
+            if presence:
+                room.presence.apply(message.fields)
+            room.deliver(message, exclude, control=presence)
+
+        elif op == "direct":
+            conn = self.clients.get(header.get('username'))
+            if conn:
+                conn.send(Message.from_line(data))
+
+        elif op in ("reply", "joined"):
+            future, context = self.pending.get(header.get('req'), (None, None))
+            if future is None or future.done():
+                # The client went away while the hub was joining it
+                if op == "joined":
+                    self.send({"op": "leave", "room": header['room'], "username": header['username']})
+                return
+            if header.get('error'):
+                error = RoomLimitReached if header.get('room_limit') else RuntimeError
+                future.set_exception(error(header['error']))
+                return
+            if op == "joined":
+                conn, welcome = context
+                self.local(header['room']).finish_join(header, data, conn, welcome)
+            future.set_result((header, data))
+
+    async def close(self):
+        if self.read_task:
+            self.read_task.cancel()
+        if self.writer:
+            self.writer.close()
@@ -0,0 +1,387 @@
+import asyncio
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from server_settings import HISTORY_BATCH_SIZE, HISTORY_FLUSH_INTERVAL_MS, HISTORY_DURABILITY, HISTORY_FSYNC_INTERVAL_MS, HISTORY_REPLAY_SIZE, HISTORY_PAGE_SIZE, HISTORY_RESUME_LIMIT
+from server_settings import HISTORY_THREADS, HISTORY_RETENTION_DAYS, HISTORY_RETENTION_MESSAGES, HISTORY_RETENTION_BYTES, HISTORY_COMPRESSION, HISTORY_MAINTENANCE_INTERVAL_S
+from server_history_store import HistoryStore
+from server_mentions import MentionIndex, mentioned_users
+from server_search import SearchIndex
+from protocal import Message
+from server_metrics import metrics
+
+DURABILITY_NONE = "none"
+DURABILITY_BATCH = "batch"
+DURABILITY_INTERVAL = "interval"
+
+# A failed history write is retried after this, doubling up to the max
+HISTORY_RETRY_BASE_S = 0.1
+HISTORY_RETRY_MAX_S = 5.0
+
+# Disk work for every room shares a few threads, each room's writer makes
+# sure its own calls still run one at a time and in order. Old segments are
+# compressed one at a time on a thread of their own.
+history_executor = ThreadPoolExecutor(max_workers=HISTORY_THREADS, thread_name_prefix="history-writer")
+compress_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-compress")
+
+
+class HistoryRing:
+    # The last few messages kept as already encoded Message objects, so a
+    # JOIN replays them without touching the disk or doing any JSON work.
+
+    def __init__(self, size=HISTORY_REPLAY_SIZE):
+        self.messages = deque(maxlen=size)
+        self.seqs = deque(maxlen=size)
+
+    def append(self, seq, message):
+        self.seqs.append(seq)
+        self.messages.append(message)
+
+    def prune(self, first_seq):
+        while self.seqs and self.seqs[0] < first_seq:
+            self.seqs.popleft()
+            self.messages.popleft()
+
+    def load(self, first_seq, lines):
+        for seq, line in enumerate(lines, first_seq):
+            self.append(seq, Message.from_line(line))
+
+    @property
+    def first_seq(self):
+        return self.seqs[0] if self.seqs else None
+
+    def covers(self, seq):
+        # True if every message after seq is still in the ring
+        return bool(self.seqs) and self.seqs[0] <= seq + 1
+
+    def chunks(self, after_seq=None, max_bytes=256 * 1024):
+        messages = list(self.messages)
+        if after_seq is not None and self.seqs:
+            messages = messages[max(after_seq + 1 - self.seqs[0], 0):]
+
+        chunk = []
+        size = 0
+        for message in messages:
+            chunk.append(message)
+            size += len(message.line)
+            if size >= max_bytes:
+                yield chunk
+                chunk = []
+                size = 0
+        if chunk:
+            yield chunk
+
+    def __len__(self):
+        return len(self.messages)
+
+    @property
+    def size(self):
+        return self.messages.maxlen
+
+
+class HistoryWriter:
+    # Group commit: save_message only queues the line, the writer task turns
+    # everything queued within one tick (or batch_size lines) into a single
+    # write on a background thread so the event loop never blocks on disk.
+
+    def __init__(self, sink, batch_size=HISTORY_BATCH_SIZE, flush_interval_ms=HISTORY_FLUSH_INTERVAL_MS,
+                 durability=HISTORY_DURABILITY, fsync_interval_ms=HISTORY_FSYNC_INTERVAL_MS):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.durability = durability
+        self.fsync_interval = fsync_interval_ms / 1000
+        self.pending = []
+        self.pending_since = None
+        self.wakeup = asyncio.Event()
+        self.batch_full = asyncio.Event()
+        self.thread_lock = asyncio.Lock()
+        self.task = None
+        self.last_sync = time.monotonic()
+        self.unsynced = False
+        self.failures = 0
+        self.retry_at = None
+        self.stopping = False
+        self.lock = asyncio.Lock()
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    def submit(self, entry):
+        if not self.pending:
+            self.pending_since = time.perf_counter()
+        self.pending.append(entry)
+        self.wakeup.set()
+        if len(self.pending) >= self.batch_size:
+            self.batch_full.set()
+
+    async def run_in_thread(self, func, *args):
+        loop = asyncio.get_running_loop()
+        async with self.thread_lock:
+            return await loop.run_in_executor(history_executor, func, *args)
+
+    async def flush(self):
+        async with self.lock:
+            return await self.flush_locked()
+
+    async def flush_locked(self):
+        # flush() for callers that already hold self.lock
+        if not self.pending:
+            return True
+        batch = self.pending
+        pending_since = self.pending_since
+        self.pending = []
+        self.batch_full.clear()
+
+        sync = self.durability == DURABILITY_BATCH
+        if self.durability == DURABILITY_INTERVAL and time.monotonic() - self.last_sync >= self.fsync_interval:
+            sync = True
+
+        started = time.perf_counter()
+        try:
+            await self.run_in_thread(self.sink.write, batch, sync)
+        except Exception as e:
+            # The store rolled the batch back, so it goes back in front
+            # of anything queued since and is tried again shortly
+            self.pending[:0] = batch
+            self.pending_since = pending_since
+            self.failures += 1
+            delay = min(HISTORY_RETRY_BASE_S * 2 ** (self.failures - 1), HISTORY_RETRY_MAX_S)
+            print(f"Error saving {len(batch)} messages to history, retrying in {delay:.1f}s: {e}")
+            self.retry_at = time.monotonic() + delay
+            asyncio.get_running_loop().call_later(delay, self.wakeup.set)
+            return False
+        self.failures = 0
+        self.retry_at = None
+        finished = time.perf_counter()
+        # history_lag is how long the oldest message in the batch waited
+        metrics.observe("history_write", finished - started)
+        metrics.observe("history_lag", finished - pending_since)
+
+        if sync:
+            self.last_sync = time.monotonic()
+            self.unsynced = False
+        elif self.durability == DURABILITY_INTERVAL:
+            self.unsynced = True
+        return True
+
+    async def sync(self):
+        try:
+            await self.run_in_thread(self.sink.sync)
+            self.last_sync = time.monotonic()
+            self.unsynced = False
+        except Exception as e:
+            print(f"Error syncing history: {e}")
+
+    async def _run(self):
+        # Runs until close() sets stopping, never cancelled, so a write in
+        # progress always finishes and its batch is accounted for
+        try:
+            while not self.stopping:
+                if self.unsynced:
+                    # Interval mode: make sure the tail gets synced even if traffic stops
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), self.fsync_interval)
+                    except asyncio.TimeoutError:
+                        await self.sync()
+                        continue
+                else:
+                    await self.wakeup.wait()
+                self.wakeup.clear()
+                if self.stopping:
+                    break
+                if self.retry_at is not None and time.monotonic() < self.retry_at:
+                    # New messages don't cut a failing disk's backoff short
+                    continue
+
+                if len(self.pending) < self.batch_size:
+                    try:
+                        await asyncio.wait_for(self.batch_full.wait(), self.flush_interval)
+                    except asyncio.TimeoutError:
+                        pass
+
+                await self.flush()
+        except asyncio.CancelledError:
+            pass
+
+    async def close(self):
+        if self.task:
+            self.stopping = True
+            self.wakeup.set()
+            await self.task
+            self.task = None
+
+        if self.pending and not await self.flush():
+            print(f"{len(self.pending)} messages could not be saved to history")
+        if self.durability != DURABILITY_NONE:
+            await self.sync()
+        await self.run_in_thread(self.sink.close)
+
+
+class History:
+    # Everything a history stream needs: the segmented store on disk, the
+    # replay ring in memory and the group-commit writer in between.
+
+    def __init__(self, directory, legacy_file=None):
+        self.store = HistoryStore(directory, legacy_file)
+        self.ring = HistoryRing()
+        self.writer = HistoryWriter(self.store)
+        self.mentions = MentionIndex()
+        self.search_index = SearchIndex()
+        self.maintenance = None
+        self.next_seq = 1
+
+    async def open(self):
+        await self.writer.run_in_thread(self.store.open)
+        self.next_seq = self.store.next_seq
+        lines, _ = await self.writer.run_in_thread(self.store.page, None, None, self.ring.size)
+        self.ring.load(self.next_seq - len(lines), lines)
+        await self.writer.run_in_thread(self.build_indexes)
+        self.writer.start()
+        if HISTORY_MAINTENANCE_INTERVAL_S > 0:
+            self.maintenance = asyncio.create_task(self._maintain())
+
+    def build_indexes(self):
+        # Runs on the writer thread when the room opens, before anything new
+        # is appended: one pass over the log feeds every index
+        self.mentions.clear()
+        self.search_index.clear()
+        for seq, line in self.store.scan():
+            try:
+                message = json.loads(line)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                continue
+            users = mentioned_users(message)
+            if users:
+                self.mentions.add(seq, users)
+            self.search_index.add(seq, message)
+
+    def append(self, message, mentions=()):
+        # Seqs are handed out here on the loop so what gets broadcast carries
+        # the same seq as what is written to disk. The returned Message is
+        # encoded once and shared by the ring, the writer and the fan-out.
+        # The time is the server's, the time index and retention rely on it.
+        message['timestamp'] = datetime.now().isoformat()
+        seq = message['seq'] = self.next_seq
+        self.next_seq += 1
+        if mentions:
+            self.mentions.add(seq, mentions)
+        self.search_index.add(seq, message)
+        message = Message(message)
+        self.ring.append(seq, message)
+        self.writer.submit((seq, message.get('timestamp', ''), message.line))
+        return message
+
+    @property
+    def last_seq(self):
+        return self.next_seq - 1
+
+    async def read_gap(self, seq):
+        # Disk part of a resume after seq: (lines, last seq read), or None
+        # when the client has to drop its scrollback and take a full replay.
+        if seq > self.last_seq:
+            return None
+        if seq == self.last_seq or self.ring.covers(seq):
+            return [], seq
+        if seq + 1 < self.store.first_seq or self.last_seq - seq > HISTORY_RESUME_LIMIT:
+            return None
+
+        end = self.ring.first_seq or self.next_seq
+        await self.writer.flush()
+        lines, _ = await self.writer.run_in_thread(self.store.page, None, seq, end - seq - 1)
+        return lines, seq + len(lines)
+
+    def replay_chunks(self, gap=None):
+        # Synchronous on purpose: the caller queues the result before any
+        # other broadcast can run. None means the ring moved past the gap.
+        if gap is None:
+            return list(self.ring.chunks())
+        lines, last = gap
+        if last != self.last_seq and not self.ring.covers(last):
+            return None
+        chunks = [[Message.from_line(line) for line in lines]] if lines else []
+        return chunks + list(self.ring.chunks(after_seq=last))
+
+    async def fetch(self, before=None, after=None, before_time=None, limit=None):
+        limit = limit or HISTORY_PAGE_SIZE
+        await self.writer.flush()
+        if before_time is not None:
+            before = await self.writer.run_in_thread(self.store.seq_for_time, before_time)
+        return await self.writer.run_in_thread(self.store.page, before, after, limit)
+
+    async def fetch_mentions(self, username, after=None, limit=None):
+        seqs, has_more = self.mentions.after(username, after, limit or HISTORY_PAGE_SIZE)
+        if not seqs:
+            return [], has_more
+        await self.writer.flush()
+        return await self.writer.run_in_thread(self.store.read_seqs, seqs), has_more
+
+    async def search(self, query, before=None, limit=None):
+        seqs, has_more = self.search_index.search(query, before, limit or HISTORY_PAGE_SIZE)
+        if not seqs:
+            return [], has_more
+        await self.writer.flush()
+        return await self.writer.run_in_thread(self.store.read_seqs, seqs), has_more
+
+    async def _maintain(self):
+        try:
+            while True:
+                try:
+                    await self.maintain()
+                except Exception as e:
+                    print(f"Error maintaining history in {self.store.directory}: {e}")
+                await asyncio.sleep(HISTORY_MAINTENANCE_INTERVAL_S)
+        except asyncio.CancelledError:
+            pass
+
+    async def maintain(self):
+        # Retention drops whole segments from the front, which is only a few
+        # unlinks on the writer thread. Compression reads and writes whole
+        # segments, so it runs on its own thread and only the final rename
+        # goes through the writer.
+        before_time = None
+        if HISTORY_RETENTION_DAYS > 0:
+            before_time = (datetime.now() - timedelta(days=HISTORY_RETENTION_DAYS)).isoformat()
+        dropped = await self.writer.run_in_thread(
+            self.store.expire, HISTORY_RETENTION_MESSAGES, HISTORY_RETENTION_BYTES, before_time
+        )
+        if dropped:
+            first_seq = self.store.first_seq
+            self.mentions.prune(first_seq)
+            self.search_index.prune(first_seq)
+            print(f"Expired {dropped} messages from {self.store.directory}")
+
+        if HISTORY_COMPRESSION == "none":
+            return
+        loop = asyncio.get_running_loop()
+        for segment in await self.writer.run_in_thread(self.store.compressible):
+            temp_path = await loop.run_in_executor(compress_executor, segment.compress)
+            await self.writer.run_in_thread(self.store.finish_compress, segment, temp_path)
+
+    async def clear(self):
+        # The writer lock is held throughout, so no batch reaches the store
+        # while it is cleared. What was pending is written first, since the
+        # store only takes consecutive seqs, and then the store, ring and
+        # indexes all drop everything before the first message still
+        # pending. Messages appended meanwhile are kept after the clear.
+        async with self.writer.lock:
+            if not await self.writer.flush_locked():
+                raise RuntimeError("Pending history could not be written")
+            first_seq = self.writer.pending[0][0] if self.writer.pending else self.next_seq
+            self.ring.prune(first_seq)
+            self.mentions.prune(first_seq)
+            self.search_index.prune(first_seq)
+            await self.writer.run_in_thread(self.store.clear)
+
+    async def close(self):
+        if self.maintenance:
+            self.maintenance.cancel()
+            try:
+                await self.maintenance
+            except asyncio.CancelledError:
+                pass
+            self.maintenance = None
+        await self.writer.close()
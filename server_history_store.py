@@ -0,0 +1,544 @@
+import gzip
+import json
+import os
+import shutil
+from bisect import bisect_left, bisect_right
+from server_settings import HISTORY_SEGMENT_BYTES, HISTORY_INDEX_INTERVAL
+
+SEGMENT_SUFFIX = ".log"
+COMPRESSED_SUFFIX = ".log.gz"
+TEMP_SUFFIX = ".tmp"
+INDEX_SUFFIX = ".idx"
+# The segment being written and the one before it stay uncompressed, they
+# are the ones resumes and paging read most
+UNCOMPRESSED_SEGMENTS = 2
+
+
+class Segment:
+    # One append-only log file. Its name is the seq of its first message,
+    # and every line after that has the next seq, so a sparse index of
+    # (seq, offset, timestamp) every few messages is enough to seek anywhere.
+
+    def __init__(self, directory, base_seq):
+        self.base_seq = base_seq
+        self.path = os.path.join(directory, f"{base_seq:020d}{SEGMENT_SUFFIX}")
+        self.compressed_path = os.path.join(directory, f"{base_seq:020d}{COMPRESSED_SUFFIX}")
+        self.index_path = os.path.join(directory, f"{base_seq:020d}{INDEX_SUFFIX}")
+        self.compressed = False
+        self.index_seqs = []
+        self.index_offsets = []
+        self.index_times = []
+        self.last_seq = base_seq - 1
+        self.size = 0
+        self.file = None
+        self.index_file = None
+
+    def __len__(self):
+        return self.last_seq - self.base_seq + 1
+
+    def load_index(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) != 3:
+                        continue
+                    self.index_seqs.append(int(parts[0]))
+                    self.index_offsets.append(int(parts[1]))
+                    self.index_times.append(parts[2])
+        except FileNotFoundError:
+            pass
+
+    def open_read(self):
+        # Offsets in the index are into the uncompressed data either way,
+        # gzip seeks by decompressing up to them
+        if self.compressed:
+            return gzip.open(self.compressed_path, 'rb')
+        return open(self.path, 'rb')
+
+    def disk_size(self):
+        try:
+            return os.path.getsize(self.compressed_path if self.compressed else self.path)
+        except FileNotFoundError:
+            return 0
+
+    def recover(self):
+        # Rebuild whatever the index is missing by scanning from its last
+        # entry, and cut off a partially written last line.
+        if self.compressed:
+            self._recover_compressed()
+            return
+        size = os.path.getsize(self.path)
+        if self.index_offsets and self.index_offsets[-1] > size:
+            while self.index_offsets and self.index_offsets[-1] > size:
+                self.index_seqs.pop()
+                self.index_offsets.pop()
+                self.index_times.pop()
+            self._rewrite_index()
+
+        if self.index_seqs:
+            seq = self.index_seqs[-1]
+            offset = self.index_offsets[-1]
+        else:
+            seq = self.base_seq
+            offset = 0
+
+        with open(self.path, 'rb+') as f:
+            f.seek(offset)
+            while True:
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    f.truncate(offset)
+                    break
+                if (seq - self.base_seq) % HISTORY_INDEX_INTERVAL == 0 and (not self.index_seqs or seq > self.index_seqs[-1]):
+                    self._add_index(seq, offset, message_time(line))
+                offset += len(line)
+                seq += 1
+
+        self.last_seq = seq - 1
+        self.size = offset
+
+    def _recover_compressed(self):
+        # Compressed segments were complete when they were closed, only the
+        # index can be missing
+        self.index_seqs, self.index_offsets, self.index_times = [], [], []
+        seq = self.base_seq
+        offset = 0
+        for line in self.scan():
+            if (seq - self.base_seq) % HISTORY_INDEX_INTERVAL == 0:
+                self.index_seqs.append(seq)
+                self.index_offsets.append(offset)
+                self.index_times.append(message_time(line))
+            offset += len(line)
+            seq += 1
+        self._rewrite_index()
+        self.last_seq = seq - 1
+        self.size = offset
+
+    def _rewrite_index(self):
+        with open(self.index_path, 'w', encoding='utf-8') as f:
+            for seq, offset, timestamp in zip(self.index_seqs, self.index_offsets, self.index_times):
+                f.write(f"{seq} {offset} {timestamp}\n")
+
+    def _add_index(self, seq, offset, timestamp):
+        self.index_seqs.append(seq)
+        self.index_offsets.append(offset)
+        self.index_times.append(timestamp)
+        if self.index_file:
+            self.index_file.write(f"{seq} {offset} {timestamp}\n")
+        else:
+            with open(self.index_path, 'a', encoding='utf-8') as f:
+                f.write(f"{seq} {offset} {timestamp}\n")
+
+    def open_for_append(self):
+        if self.file is None:
+            self.file = open(self.path, 'ab')
+            self.index_file = open(self.index_path, 'a', encoding='utf-8')
+
+    def append(self, seq, timestamp, data):
+        if seq != self.last_seq + 1:
+            raise ValueError(f"Out of order seq {seq}, expected {self.last_seq + 1}")
+        if (seq - self.base_seq) % HISTORY_INDEX_INTERVAL == 0:
+            self._add_index(seq, self.size, timestamp)
+        self.file.write(data)
+        self.size += len(data)
+        self.last_seq = seq
+
+    def mark(self):
+        return self.last_seq, self.size, len(self.index_seqs)
+
+    def rollback(self, mark):
+        # Back to a mark(): buffered writes are dropped and the files cut
+        # back, so nothing half written stays in front of later lines
+        last_seq, size, index_count = mark
+        for f in (self.file, self.index_file):
+            try:
+                if f:
+                    f.close()
+            except OSError:
+                pass
+        self.file = None
+        self.index_file = None
+        if not self.compressed:
+            with open(self.path, 'rb+') as f:
+                f.truncate(size)
+        del self.index_seqs[index_count:]
+        del self.index_offsets[index_count:]
+        del self.index_times[index_count:]
+        self._rewrite_index()
+        self.last_seq = last_seq
+        self.size = size
+
+    def flush(self, sync=False):
+        if self.file:
+            self.file.flush()
+            self.index_file.flush()
+            if sync:
+                os.fsync(self.file.fileno())
+                os.fsync(self.index_file.fileno())
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.index_file.close()
+            self.file = None
+            self.index_file = None
+
+    def offset_for(self, seq):
+        i = bisect_right(self.index_seqs, seq) - 1
+        if i < 0:
+            return self.base_seq, 0
+        return self.index_seqs[i], self.index_offsets[i]
+
+    def seq_for_time(self, timestamp):
+        # First indexed seq at or after timestamp, used as a starting point
+        i = bisect_left(self.index_times, timestamp)
+        if i == 0:
+            return self.base_seq
+        return self.index_seqs[i - 1]
+
+    def read(self, start_seq, end_seq):
+        # Lines with start_seq <= seq < end_seq
+        start_seq = max(start_seq, self.base_seq)
+        end_seq = min(end_seq, self.last_seq + 1)
+        if start_seq >= end_seq:
+            return []
+
+        seq, offset = self.offset_for(start_seq)
+        lines = []
+        with self.open_read() as f:
+            f.seek(offset)
+            while seq < end_seq:
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    break
+                if seq >= start_seq:
+                    lines.append(line)
+                seq += 1
+        return lines
+
+    def read_seqs(self, seqs):
+        # Lines for ascending seqs in one forward pass. The index is only
+        # used to skip ahead, never back, so a compressed segment is
+        # decompressed at most once.
+        lines = []
+        seq = self.base_seq
+        with self.open_read() as f:
+            for wanted in seqs:
+                index_seq, offset = self.offset_for(wanted)
+                if index_seq > seq:
+                    f.seek(offset)
+                    seq = index_seq
+                while seq <= wanted:
+                    line = f.readline()
+                    if not line.endswith(b'\n'):
+                        return lines
+                    if seq == wanted:
+                        lines.append(line)
+                    seq += 1
+        return lines
+
+    def scan(self):
+        # Every line in the segment, in order
+        with self.open_read() as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                yield line
+
+    def compress(self):
+        # Runs on a thread of its own, not the history writer, since it reads
+        # the whole segment. Only closed segments are compressed, so nothing
+        # writes to the file meanwhile. Returns the temporary file, swapped
+        # in by finish_compress on the writer thread.
+        temp_path = self.compressed_path + TEMP_SUFFIX
+        with open(self.path, 'rb') as src, gzip.open(temp_path, 'wb', compresslevel=6) as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        return temp_path
+
+    def finish_compress(self, temp_path):
+        if self.compressed or not os.path.exists(self.path):
+            remove_file(temp_path)
+            return
+        os.replace(temp_path, self.compressed_path)
+        self.compressed = True
+        os.remove(self.path)
+
+    def delete(self):
+        self.close()
+        for path in (self.path, self.compressed_path, self.index_path):
+            remove_file(path)
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def message_time(line):
+    try:
+        return json.loads(line).get('timestamp') or ''
+    except (json.JSONDecodeError, UnicodeDecodeError, AttributeError):
+        return ''
+
+
+class HistoryStore:
+    # Segmented, append-only history log. All methods run on the history
+    # writer thread, never on the event loop.
+
+    def __init__(self, directory, legacy_file=None, segment_bytes=HISTORY_SEGMENT_BYTES):
+        self.directory = directory
+        self.legacy_file = legacy_file
+        self.segment_bytes = segment_bytes
+        self.segments = []
+        self.base_seqs = []
+
+    @property
+    def first_seq(self):
+        return self.segments[0].base_seq if self.segments else self.next_seq
+
+    @property
+    def last_seq(self):
+        return self.segments[-1].last_seq if self.segments else 0
+
+    @property
+    def next_seq(self):
+        return self.last_seq + 1
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        names = os.listdir(self.directory)
+        base_seqs = set()
+        compressed = set()
+        for name in names:
+            if name.endswith(TEMP_SUFFIX):
+                # A compression that never finished
+                remove_file(os.path.join(self.directory, name))
+            elif name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit():
+                base_seqs.add(int(name[:-len(SEGMENT_SUFFIX)]))
+            elif name.endswith(COMPRESSED_SUFFIX) and name[:-len(COMPRESSED_SUFFIX)].isdigit():
+                compressed.add(int(name[:-len(COMPRESSED_SUFFIX)]))
+
+        for base_seq in sorted(base_seqs | compressed):
+            segment = Segment(self.directory, base_seq)
+            if base_seq in compressed:
+                if base_seq in base_seqs:
+                    # Stopped between writing the .gz and removing the
+                    # original, the original is still whole
+                    remove_file(segment.compressed_path)
+                else:
+                    segment.compressed = True
+            segment.load_index()
+            self.segments.append(segment)
+            self.base_seqs.append(base_seq)
+
+        for segment in self.segments[:-1]:
+            if not segment.index_seqs:
+                segment.recover()
+            else:
+                segment.last_seq = self._next_base(segment) - 1
+                segment.size = segment.disk_size()
+        if self.segments:
+            self.segments[-1].recover()
+
+        if not self.segments and self.legacy_file and os.path.exists(self.legacy_file):
+            self._import_legacy()
+
+    def _next_base(self, segment):
+        i = self.segments.index(segment)
+        return self.segments[i + 1].base_seq
+
+    def _import_legacy(self):
+        # One time move of the old single chat_history.txt into segments
+        count = 0
+        with open(self.legacy_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    message = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                message['seq'] = self.next_seq
+                data = (json.dumps(message) + '\n').encode('utf-8')
+                self.append(message['seq'], message.get('timestamp', ''), data)
+                count += 1
+        self.flush()
+        os.replace(self.legacy_file, self.legacy_file + ".migrated")
+        print(f"Imported {count} messages from {self.legacy_file}")
+
+    def _active_segment(self):
+        segment = self.segments[-1] if self.segments else None
+        if segment is None or segment.compressed or segment.size >= self.segment_bytes:
+            if segment:
+                segment.flush()
+                segment.close()
+            segment = Segment(self.directory, self.next_seq)
+            self.segments.append(segment)
+            self.base_seqs.append(segment.base_seq)
+        segment.open_for_append()
+        return segment
+
+    def append(self, seq, timestamp, data):
+        self._active_segment().append(seq, timestamp, data)
+
+    def write(self, entries, sync=False):
+        # All or nothing, so a batch that failed can be retried as it is
+        count = len(self.segments)
+        mark = self.segments[-1].mark() if self.segments else None
+        try:
+            for seq, timestamp, data in entries:
+                self.append(seq, timestamp, data)
+            self.flush(sync)
+        except Exception:
+            self._rollback(count, mark)
+            raise
+
+    def _rollback(self, count, mark):
+        # Segments the batch rolled over into go, the one it started in is cut back
+        while len(self.segments) > max(count, 1):
+            self.segments.pop().delete()
+            self.base_seqs.pop()
+        if mark is not None:
+            self.segments[-1].rollback(mark)
+        elif self.segments:
+            self.segments.pop().delete()
+            self.base_seqs.pop()
+
+    def flush(self, sync=False):
+        if self.segments:
+            self.segments[-1].flush(sync)
+
+    def sync(self):
+        self.flush(sync=True)
+
+    def clear(self):
+        # Drop every segment but keep counting seqs from where we were
+        next_seq = self.next_seq
+        for segment in self.segments:
+            segment.delete()
+        # An empty segment file remembers next_seq across restarts
+        segment = Segment(self.directory, next_seq)
+        segment.open_for_append()
+        self.segments = [segment]
+        self.base_seqs = [next_seq]
+
+    def close(self):
+        self.flush()
+        for segment in self.segments:
+            segment.close()
+
+    def compressible(self):
+        # Closed segments that should be compressed, oldest first
+        return [segment for segment in self.segments[:-UNCOMPRESSED_SEGMENTS] if not segment.compressed]
+
+    def finish_compress(self, segment, temp_path):
+        if segment in self.segments:
+            segment.finish_compress(temp_path)
+        else:
+            # Dropped by clear while it was being compressed
+            remove_file(temp_path)
+
+    def disk_size(self):
+        return sum(segment.disk_size() for segment in self.segments)
+
+    def expire(self, max_messages=0, max_bytes=0, before_time=None):
+        # Drop whole segments from the front while they are over a limit.
+        # The segment being written is never dropped. Returns how many
+        # messages went.
+        dropped = 0
+        total_bytes = self.disk_size() if max_bytes else 0
+        while len(self.segments) > 1:
+            segment, following = self.segments[0], self.segments[1]
+            over_count = max_messages and self.last_seq - following.base_seq + 1 >= max_messages
+            over_bytes = max_bytes and total_bytes > max_bytes
+            # Everything in the segment is older than the first message of the next one
+            too_old = before_time and following.index_times and following.index_times[0] < before_time
+            if not (over_count or over_bytes or too_old):
+                break
+            total_bytes -= segment.disk_size()
+            dropped += len(segment)
+            segment.delete()
+            self.segments.pop(0)
+            self.base_seqs.pop(0)
+        return dropped
+
+    def read(self, start_seq, end_seq):
+        start_seq = max(start_seq, self.first_seq)
+        end_seq = min(end_seq, self.next_seq)
+        lines = []
+        i = max(bisect_right(self.base_seqs, start_seq) - 1, 0)
+        while i < len(self.segments) and start_seq < end_seq:
+            segment = self.segments[i]
+            lines.extend(segment.read(start_seq, end_seq))
+            start_seq = max(start_seq, segment.last_seq + 1)
+            i += 1
+        return lines
+
+    def scan(self, start_seq=None):
+        # (seq, line) for the whole log from start_seq on, one segment at a
+        # time so it never holds more than a line in memory
+        self.flush()
+        for segment in list(self.segments):
+            seq = segment.base_seq
+            if segment.last_seq < (start_seq or 0):
+                continue
+            for line in segment.scan():
+                if seq > segment.last_seq:
+                    break
+                if start_seq is None or seq >= start_seq:
+                    yield seq, line
+                seq += 1
+
+    def read_seqs(self, seqs):
+        # The lines for a handful of scattered seqs, in ascending order.
+        # Seqs are grouped by segment so each file is opened once.
+        lines = []
+        group = []
+        segment = None
+        for seq in seqs:
+            if seq < self.first_seq or seq > self.last_seq:
+                continue
+            if segment is None or seq > segment.last_seq:
+                if group:
+                    lines.extend(segment.read_seqs(group))
+                segment = self.segments[bisect_right(self.base_seqs, seq) - 1]
+                group = []
+            group.append(seq)
+        if group:
+            lines.extend(segment.read_seqs(group))
+        return lines
+
+    def seq_for_time(self, timestamp):
+        # First seq whose timestamp is >= the given ISO timestamp
+        if not self.segments:
+            return self.next_seq
+        times = [segment.index_times[0] if segment.index_times else '' for segment in self.segments]
+        i = max(bisect_right(times, timestamp) - 1, 0)
+        segment = self.segments[i]
+        seq = segment.seq_for_time(timestamp)
+        while seq <= self.last_seq:
+            lines = self.read(seq, seq + HISTORY_INDEX_INTERVAL)
+            for line in lines:
+                if message_time(line) >= timestamp:
+                    return seq
+                seq += 1
+            if not lines:
+                break
+        return self.next_seq
+
+    def page(self, before=None, after=None, limit=50):
+        # Messages strictly before or after a seq cursor, oldest first
+        if after is not None:
+            start = max(after + 1, self.first_seq)
+            lines = self.read(start, start + limit)
+            has_more = start + limit < self.next_seq
+        else:
+            end = self.next_seq if before is None else min(before, self.next_seq)
+            start = max(end - limit, self.first_seq)
+            lines = self.read(start, end)
+            has_more = start > self.first_seq
+        return lines, has_more
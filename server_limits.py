@@ -0,0 +1,93 @@
+import asyncio
+import math
+import time
+from server_settings import RATE_LIMIT_MESSAGES, RATE_LIMIT_MESSAGE_BURST, RATE_LIMIT_BYTES, RATE_LIMIT_BYTE_BURST, MAX_FRAME_BYTES
+from server_settings import ADMISSION_MAX_HANDSHAKES, ADMISSION_QUEUE_SIZE, ADMISSION_WAIT_S
+
+
+class TokenBucket:
+    # rate tokens a second up to capacity, a rate of 0 means no limit
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def has(self, amount):
+        if self.rate <= 0:
+            return True
+        self.refill()
+        return self.tokens >= amount
+
+    def take(self, amount):
+        if self.rate > 0:
+            self.tokens -= amount
+
+
+class RateLimiter:
+    # Per connection limits on messages and bytes a second. Works on the
+    # raw frame size so nothing gets decoded for a client that is over it.
+
+    def __init__(self, messages=RATE_LIMIT_MESSAGES, message_burst=RATE_LIMIT_MESSAGE_BURST,
+                 byte_rate=RATE_LIMIT_BYTES, byte_burst=RATE_LIMIT_BYTE_BURST):
+        self.messages = TokenBucket(messages, max(message_burst, 1))
+        # The byte bucket always has room for one full sized frame
+        self.bytes = TokenBucket(byte_rate, max(byte_burst, MAX_FRAME_BYTES))
+        self.throttled = False
+
+    def allow(self, size):
+        if self.messages.has(1) and self.bytes.has(size):
+            self.messages.take(1)
+            self.bytes.take(size)
+            self.throttled = False
+            return True
+        return False
+
+
+class Admission:
+    # Caps how many JOIN handshakes (username claim, history replay, join
+    # broadcasts) run at once. Up to queue_size more wait their turn, anyone
+    # past that or waiting too long is told when to come back instead.
+
+    def __init__(self, limit=ADMISSION_MAX_HANDSHAKES, queue_size=ADMISSION_QUEUE_SIZE, wait=ADMISSION_WAIT_S):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.wait = wait
+        self.slots = asyncio.Semaphore(max(limit, 1))
+        self.waiting = 0
+        self.handshake_time = 0.05
+
+    async def admit(self):
+        if self.limit <= 0:
+            return True
+        if not self.slots.locked():
+            await self.slots.acquire()
+            return True
+        if self.waiting >= self.queue_size:
+            return False
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.wait)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.waiting -= 1
+
+    def release(self, started):
+        if self.limit <= 0:
+            return
+        # Moving average of how long a handshake takes, for retry_after
+        self.handshake_time = self.handshake_time * 0.9 + (time.perf_counter() - started) * 0.1
+        self.slots.release()
+
+    def retry_after(self):
+        # Roughly how long until the backlog ahead of this client clears
+        backlog = self.waiting + self.limit
+        return max(1, min(60, math.ceil(backlog * self.handshake_time / max(self.limit, 1))))
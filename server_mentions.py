@@ -0,0 +1,44 @@
+from bisect import bisect_right
+from protocal import *
+from server_postings import Postings
+
+# @name mentions are pulled out of each message once, when it is stored.
+# Every room keeps username -> seqs of the messages that mention them, so
+# FETCH_MENTIONS reads just those lines instead of scanning the history.
+# Names follow USERNAME_PATTERN, so MENTION_PATTERN finds them whole.
+MENTION_PREVIEW_CHARS = 100
+
+
+def mentioned_users(message):
+    content = message.get('content')
+    if message.get('type') != MSG_MESSAGE or not isinstance(content, str) or '@' not in content:
+        return ()
+    users = set(MENTION_PATTERN.findall(content))
+    users.discard(message.get('sender'))
+    return users
+
+
+def mention_event(message, room_name, seq):
+    # Small on purpose, the client fetches the message itself if it wants it.
+    # Room and seq live in the content so the client doesn't treat this as a
+    # message in the room it is looking at.
+    content = message.get('content')
+    if len(content) > MENTION_PREVIEW_CHARS:
+        content = content[:MENTION_PREVIEW_CHARS] + "..."
+    return createMessage(
+        sender=message.get('sender'),
+        type=MSG_MENTION,
+        content={"room": room_name, "seq": seq, "text": content}
+    )
+
+
+class MentionIndex(Postings):
+
+    def after(self, username, after=None, limit=50):
+        # Seqs mentioning username after the cursor, oldest first, and
+        # whether there are more
+        seqs = self.seqs.get(username)
+        if not seqs:
+            return [], False
+        start = bisect_right(seqs, after) if after is not None else 0
+        return list(seqs[start:start + limit]), start + limit < len(seqs)
@@ -0,0 +1,140 @@
+import asyncio
+import json
+import os
+import time
+from bisect import bisect_left
+from datetime import datetime
+from server_settings import METRICS_FILE, METRICS_INTERVAL_S
+
+# Bucket upper bounds in seconds, 50us doubling up to about 50s
+BUCKETS = [0.00005 * 2 ** i for i in range(21)]
+
+
+class Histogram:
+    # Fixed log scale buckets, cheap enough to observe on every message
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        target = self.count * p
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+        return self.max
+
+    def snapshot(self):
+        def ms(seconds):
+            return round(seconds * 1000, 3) if seconds is not None else None
+
+        return {
+            "count": self.count,
+            "avg_ms": ms(self.total / self.count) if self.count else None,
+            "p50_ms": ms(self.percentile(0.50)),
+            "p95_ms": ms(self.percentile(0.95)),
+            "p99_ms": ms(self.percentile(0.99)),
+            "max_ms": ms(self.max),
+        }
+
+
+class Metrics:
+    # Process wide counters and histograms. Rates are worked out once per
+    # interval by tick(), so reading them never does any extra work.
+
+    COUNTERS = ("messages_in", "messages_out", "bytes_out", "socket_writes", "dropped", "joins", "joins_refused")
+    HISTOGRAMS = ("broadcast", "replay", "join", "history_write", "history_lag")
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {name: 0 for name in self.COUNTERS}
+        self.histograms = {name: Histogram() for name in self.HISTOGRAMS}
+        self.rates = {name: 0.0 for name in self.COUNTERS}
+        self.last_tick = time.monotonic()
+        self.last_counters = dict(self.counters)
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def observe(self, name, seconds):
+        self.histograms[name].observe(seconds)
+
+    def tick(self):
+        now = time.monotonic()
+        elapsed = now - self.last_tick
+        if elapsed > 0:
+            for name, value in self.counters.items():
+                self.rates[name] = round((value - self.last_counters[name]) / elapsed, 1)
+        self.last_tick = now
+        self.last_counters = dict(self.counters)
+
+    def snapshot(self, clients=None):
+        connections = {}
+        for username, conn in list((clients or {}).items()):
+            connections[username] = {
+                "queue": conn.pending(),
+                "bytes_sent": conn.bytes_sent,
+                "writes": conn.writes,
+                "dropped": conn.dropped,
+            }
+        return {
+            "time": datetime.now().isoformat(),
+            "pid": os.getpid(),
+            "uptime_s": round(time.time() - self.started, 1),
+            "counters": dict(self.counters),
+            "per_sec": dict(self.rates),
+            "histograms": {name: histogram.snapshot() for name, histogram in self.histograms.items()},
+            "connections": connections,
+        }
+
+
+metrics = Metrics()
+
+
+def format_stats(snapshot):
+    lines = [f"Uptime {snapshot['uptime_s']}s, {len(snapshot['connections'])} connections"]
+    rates = snapshot['per_sec']
+    counters = snapshot['counters']
+    lines.append(f"  in  {rates['messages_in']}/s ({counters['messages_in']} total)")
+    lines.append(f"  out {rates['messages_out']}/s, {rates['bytes_out']} B/s, {rates['socket_writes']} writes/s "
+                 f"({counters['messages_out']} total, {counters['dropped']} dropped)")
+    for name, histogram in snapshot['histograms'].items():
+        if histogram['count']:
+            lines.append(f"  {name:<14} n={histogram['count']} avg={histogram['avg_ms']}ms p50={histogram['p50_ms']}ms "
+                         f"p95={histogram['p95_ms']}ms p99={histogram['p99_ms']}ms max={histogram['max_ms']}ms")
+
+    busiest = sorted(snapshot['connections'].items(), key=lambda item: item[1]['queue'], reverse=True)[:5]
+    if busiest:
+        lines.append("  deepest outbound queues:")
+        for username, conn in busiest:
+            lines.append(f"    {username}: {conn['queue']} queued, {conn['bytes_sent']} bytes sent, {conn['dropped']} dropped")
+    return "\n".join(lines)
+
+
+async def report_metrics(clients, path=METRICS_FILE, interval=METRICS_INTERVAL_S):
+    # Updates the rates every interval and, if a file is set, appends a
+    # snapshot to it as one JSON line
+    while True:
+        await asyncio.sleep(interval)
+        metrics.tick()
+        if not path:
+            continue
+        try:
+            line = json.dumps(metrics.snapshot(clients)) + "\n"
+            with open(path, "a") as f:
+                f.write(line)
+        except Exception as e:
+            print(f"Error writing metrics: {e}")
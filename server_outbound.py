@@ -0,0 +1,315 @@
+import asyncio
+import socket
+import time
+from collections import deque
+from protocal import *
+from server_settings import OUTBOUND_QUEUE_SIZE, SLOW_CONSUMER_POLICY, HEARTBEAT_INTERVAL_S, HEARTBEAT_TIMEOUT_S, MAX_FRAME_BYTES, WRITE_COALESCE_BYTES, OUTBOUND_MAX_BYTES
+from server_limits import RateLimiter
+from server_metrics import metrics
+
+POLICY_DROP_OLDEST = "drop_oldest"
+POLICY_DROP_NEW = "drop_new"
+POLICY_DISCONNECT = "disconnect"
+
+
+# Broadcasts only enqueue encoded messages, the writer task drains them
+# into the socket so one slow peer never holds up everyone else.
+#
+# Each connection has three lanes, written in this order:
+#   control - replies, errors, pings and presence, never dropped
+#   bulk    - history replay, never dropped
+#   queue   - live chat, bounded by the slow consumer policy
+# Control jumps ahead of a long replay, so requests don't time out while a
+# client catches up. Live messages wait for the replay so seqs stay in order.
+# Whatever the lane, a client with more than max_bytes waiting is not
+# reading and gets disconnected.
+#
+# Whatever piled up since the writer last ran, up to WRITE_COALESCE_BYTES,
+# goes out in one write, so a busy room costs one send per client per tick
+# instead of one per message. Nagle is off so a lone message isn't held back.
+class ClientConnection:
+
+    def __init__(self, reader, writer, username=None, maxsize=OUTBOUND_QUEUE_SIZE, policy=SLOW_CONSUMER_POLICY, framing=FRAMING_JSON,
+                 coalesce_bytes=WRITE_COALESCE_BYTES, max_bytes=OUTBOUND_MAX_BYTES):
+        self.reader = reader
+        self.writer = writer
+        self.username = username
+        self.rooms = set()
+        self.policy = policy
+        self.maxsize = maxsize
+        self.queue = deque()
+        self.control = deque()
+        self.bulk = deque()
+        self.ready = asyncio.Event()
+        self.coalesce_bytes = coalesce_bytes
+        self.max_bytes = max_bytes
+        self.queued_bytes = 0
+        self.dropped = 0
+        self.bytes_sent = 0
+        self.writes = 0
+        self.last_seen = time.monotonic()
+        self.closed = False
+        self.writer_task = None
+        self.framing = framing
+        self.frames = FrameReader(reader, MAX_FRAME_BYTES) if framing == FRAMING_BINARY else None
+        self.limiter = RateLimiter()
+        self.known_names = {0}
+        set_nodelay(writer)
+
+    def start(self):
+        if self.writer_task is None:
+            self.writer_task = asyncio.create_task(self._write_loop())
+
+    def _encode(self, data):
+        # data is a Message, a list of them (history replay) or JSON line
+        # bytes. Each Message caches its own encodings, so a fan-out encodes
+        # it once whatever mix of clients is listening. Names this client
+        # has not seen yet ride along and only count as known once the
+        # writer actually sends them.
+        if self.frames is None:
+            if isinstance(data, Message):
+                return data.line
+            if isinstance(data, list):
+                return b''.join(message.line for message in data)
+            return data
+
+        if isinstance(data, Message):
+            frames, name_ids = data.frame
+        elif isinstance(data, list):
+            name_ids = set()
+            for message in data:
+                name_ids.update(message.frame[1])
+            frames = b''.join(message.frame[0] for message in data)
+        else:
+            frames, name_ids = frames_from_lines(data)
+        new_ids = {name_id for name_id in name_ids if name_id not in self.known_names}
+        if not new_ids:
+            return frames
+        return new_ids, b''.join(name_frame(name_id) for name_id in new_ids) + frames
+
+    async def _read_line(self):
+        # Like readline, but a line over the stream limit is thrown away as
+        # it arrives instead of being buffered
+        try:
+            return await self.reader.readuntil(b'\n')
+        except asyncio.IncompleteReadError as e:
+            return e.partial
+        except asyncio.LimitOverrunError as e:
+            size = e.consumed
+            await self.reader.readexactly(e.consumed)
+            while True:
+                try:
+                    size += len(await self.reader.readuntil(b'\n'))
+                    break
+                except asyncio.LimitOverrunError as e:
+                    size += e.consumed
+                    await self.reader.readexactly(e.consumed)
+            raise FrameTooLarge(size)
+
+    async def read_message(self):
+        # None once the peer is gone, {} for anything that could not be
+        # decoded or was refused. Size and rate limits are checked on the
+        # raw bytes, before any decoding.
+        while True:
+            if self.closed:
+                return None
+            try:
+                if self.frames is None:
+                    data = await self._read_line()
+                    if not data:
+                        return None
+                else:
+                    data = await self.frames.read_raw()
+            except asyncio.IncompleteReadError:
+                return None
+            except FrameTooLarge as e:
+                self.last_seen = time.monotonic()
+                self.refuse(f"Message too large ({e.size} bytes, the limit is {MAX_FRAME_BYTES})")
+                return {}
+            self.last_seen = time.monotonic()
+
+            if not self.limiter.allow(len(data)):
+                # One error per burst, not one per refused message
+                if not self.limiter.throttled:
+                    self.limiter.throttled = True
+                    self.refuse("You are sending messages too fast, some were dropped")
+                return {}
+
+            if self.frames is None:
+                return deserialize(data) or {}
+            message = self.frames.decode(data)
+            if message is not None:
+                return message
+
+    def refuse(self, reason):
+        print(f"Refused message from {self.username}: {reason}")
+        self.send_control(Message(createMessage(sender="Server", type=MSG_ERROR, content=reason)))
+
+    def _enqueue(self, lane, data):
+        lane.append(data)
+        self.queued_bytes += queued_size(data)
+        if self.queued_bytes > self.max_bytes:
+            print(f"{self.username} has {self.queued_bytes} bytes waiting and is not reading, disconnecting")
+            self.abort()
+            return False
+        self.ready.set()
+        return True
+
+    def send(self, data):
+        if self.closed:
+            return False
+
+        data = self._encode(data)
+
+        if len(self.queue) < self.maxsize:
+            return self._enqueue(self.queue, data)
+
+        self.dropped += 1
+        metrics.count("dropped")
+        if self.policy == POLICY_DROP_OLDEST:
+            self.queued_bytes -= queued_size(self.queue.popleft())
+            return self._enqueue(self.queue, data)
+
+        if self.policy == POLICY_DISCONNECT:
+            print(f"{self.username} is not keeping up, disconnecting")
+            self.abort()
+
+        return False
+
+    def send_control(self, data):
+        if self.closed:
+            return False
+        return self._enqueue(self.control, self._encode(data))
+
+    def send_bulk(self, data):
+        # Queueing is synchronous, so a replay queued before the member is
+        # visible to broadcasts always lands ahead of live messages
+        if self.closed:
+            return False
+        return self._enqueue(self.bulk, self._encode(data))
+
+    def pending(self):
+        return len(self.control) + len(self.bulk) + len(self.queue)
+
+    def _take(self):
+        # The next write: queued data in lane order, up to coalesce_bytes
+        # (the first item always goes, however big). Also says whether the
+        # connection is closing.
+        batch = []
+        size = 0
+        for lane in (self.control, self.bulk, self.queue):
+            while lane and (not batch or size < self.coalesce_bytes):
+                data = lane.popleft()
+                if data is None:
+                    return batch, size, True
+                self.queued_bytes -= queued_size(data)
+                if isinstance(data, tuple):
+                    name_ids, data = data
+                    self.known_names.update(name_ids)
+                batch.append(data)
+                size += len(data)
+            if lane:
+                break
+        return batch, size, False
+
+    async def _write_loop(self):
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                while True:
+                    replaying = bool(self.bulk)
+                    batch, size, closing = self._take()
+                    if batch:
+                        self.writer.writelines(batch)
+                        self.writes += 1
+                        self.bytes_sent += size
+                        metrics.count("socket_writes")
+                        metrics.count("bytes_out", size)
+                        await self.writer.drain()
+                    if closing:
+                        return
+                    if not batch:
+                        break
+                    if replaying:
+                        # drain() doesn't yield while the socket keeps up, so
+                        # give requests read meanwhile a chance to cut in
+                        await asyncio.sleep(0)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"Error sending to {self.username}: {e}")
+            self.abort()
+
+    def abort(self):
+        # Dropping the transport makes the reader see EOF, so handle_client
+        # runs its normal cleanup for this peer.
+        self.closed = True
+        self.control.clear()
+        self.bulk.clear()
+        self.queue.clear()
+        self.queued_bytes = 0
+        try:
+            self.writer.transport.abort()
+        except Exception:
+            pass
+
+    async def close(self, timeout=2.0):
+        if self.writer_task and not self.writer_task.done():
+            if not self.closed:
+                self.queue.append(None)
+                self.ready.set()
+            try:
+                await asyncio.wait_for(self.writer_task, timeout=timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                pass
+            except Exception:
+                pass
+        self.closed = True
+
+        try:
+            self.writer.close()
+            await self.writer.wait_closed()
+        except Exception as e:
+            print(f"Error closing connection: {e}")
+
+
+def queued_size(data):
+    # Queued items are bytes, (new name ids, bytes) or the None that ends
+    # the writer
+    if data is None:
+        return 0
+    if isinstance(data, tuple):
+        return len(data[1])
+    return len(data)
+
+
+def set_nodelay(writer):
+    # asyncio already does this for TCP, but the coalescing above relies on it
+    sock = writer.get_extra_info('socket')
+    if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            pass
+
+
+async def heartbeat(clients, interval=HEARTBEAT_INTERVAL_S, timeout=HEARTBEAT_TIMEOUT_S):
+    # Anyone quiet for an interval gets a PING, anyone quiet for longer than
+    # the timeout is dropped. Aborting the transport makes handle_client
+    # clean up (rooms, queue, username) as if the peer had disconnected.
+    if interval <= 0:
+        return
+    while True:
+        await asyncio.sleep(interval)
+        now = time.monotonic()
+        ping = None
+        for username, conn in list(clients.items()):
+            idle = now - conn.last_seen
+            if idle > timeout:
+                print(f"{username} missed heartbeats for {int(idle)}s, disconnecting")
+                conn.abort()
+            elif idle >= interval:
+                if ping is None:
+                    ping = Message(createMessage(sender="Server", type=MSG_PING, content=""))
+                conn.send_control(ping)
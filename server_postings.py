@@ -0,0 +1,34 @@
+from array import array
+from bisect import bisect_left
+
+# key -> seqs of the messages it turns up in, ascending, kept as packed
+# int64 arrays. The mention index (username -> seqs) and the search index
+# (token -> seqs) are both built on this.
+
+
+class Postings:
+
+    def __init__(self):
+        self.seqs = {}
+
+    def add(self, seq, keys):
+        for key in keys:
+            seqs = self.seqs.get(key)
+            if seqs is None:
+                seqs = self.seqs[key] = array('q')
+            seqs.append(seq)
+
+    def prune(self, first_seq):
+        # Forget seqs that retention dropped from the log
+        for key, seqs in list(self.seqs.items()):
+            del seqs[:bisect_left(seqs, first_seq)]
+            if not seqs:
+                del self.seqs[key]
+
+    def clear(self):
+        self.seqs = {}
+
+
+def contains(seqs, seq):
+    i = bisect_left(seqs, seq)
+    return i < len(seqs) and seqs[i] == seq
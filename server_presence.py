@@ -0,0 +1,70 @@
+from protocal import *
+
+
+class Presence:
+    # Who is online, plus a version that goes up on every change. Clients
+    # apply the small USER_JOINED/LEFT/RENAMED events in order and only ask
+    # for the full list again if they notice they skipped a version. The
+    # room and everyone who joins it get a name id for binary framing.
+
+    def __init__(self, room=None):
+        self.room = room
+        intern_name(room)
+        self.users = []
+        self.version = 0
+
+    def _event(self, type, content):
+        self.version += 1
+        message = createMessage(sender="Server", type=type, content=content)
+        message['version'] = self.version
+        if self.room:
+            message['room'] = self.room
+        return message
+
+    def joined(self, username):
+        intern_name(username)
+        self.users.append(username)
+        return self._event(MSG_USER_JOINED, username)
+
+    def left(self, username):
+        if username not in self.users:
+            return None
+        self.users.remove(username)
+        return self._event(MSG_USER_LEFT, username)
+
+    def renamed(self, old_name, new_name):
+        intern_name(new_name)
+        self.users = [new_name if user == old_name else user for user in self.users]
+        return self._event(MSG_USER_RENAMED, {"old": old_name, "new": new_name})
+
+    def apply(self, message):
+        # Keep a mirror in step with events made elsewhere (worker processes).
+        # Anything older than what we have was already part of a full list.
+        version = message.get('version', 0)
+        if version <= self.version:
+            return
+        content = message.get('content')
+        msg_type = message.get('type')
+        if msg_type == MSG_USER_JOINED:
+            intern_name(content)
+            self.users.append(content)
+        elif msg_type == MSG_USER_LEFT and content in self.users:
+            self.users.remove(content)
+        elif msg_type == MSG_USER_RENAMED:
+            intern_name(content['new'])
+            self.users = [content['new'] if user == content['old'] else user for user in self.users]
+        self.version = version
+
+    def reset(self, users, version):
+        # Take over a full list made elsewhere
+        for username in users:
+            intern_name(username)
+        self.users = list(users)
+        self.version = version
+
+    def full_list(self):
+        message = createMessage(sender="Server", type=MSG_USERLIST, content=list(self.users))
+        message['version'] = self.version
+        if self.room:
+            message['room'] = self.room
+        return message
@@ -1,32 +1,209 @@
 from protocal import *
+from server_settings import HISTORY_PAGE_SIZE
+from server_rooms import RoomLimitReached
 
-async def handle_fetch_request(clients, msg, username, writer, broadcast):
+
+def send_response(conn, response, request_id):
+    if request_id:
+        response['request_id'] = request_id
+    conn.send_control(Message(response))
+
+
+def member_room(rooms, msg, username):
+    # The room a request is about, as long as the sender is in it
+    room = rooms.get_open(msg.get('room') or DEFAULT_ROOM)
+    if room is None or username not in room.members:
+        return None
+    return room
+
+
+async def handle_fetch_request(clients, msg, username, conn, rooms):
     msg_type = msg.get('type')
     request_id = msg.get('request_id')
 
-    if msg_type == "FETCH_USER_LIST":
-        response = createMessage(
-            sender="Server",
-            type=MSG_USERLIST,
-            content=list(clients.keys())
-        )
-        if request_id:
-            response['request_id'] = request_id
+    if msg_type in ("FETCH_USER_LIST", "FETCH_HISTORY", "FETCH_MENTIONS", "SEARCH"):
+        room = member_room(rooms, msg, username)
+        if room is None:
+            send_response(conn, createMessage(sender="Server", type=MSG_ERROR, content="You are not in that room"), request_id)
+            return True
 
-        writer.write(serialize(response))
-        await writer.drain()
+    if msg_type == "FETCH_USER_LIST":
+        presence = room.presence
+        # content is the presence version the client has, if it is still
+        # current there is no need to send the whole list again
+        if msg.get('content') == presence.version:
+            response = createMessage(sender="Server", type=MSG_SUCCESS, content="User list is up to date")
+            response['version'] = presence.version
+            response['room'] = room.name
+        else:
+            response = presence.full_list()
+
+        send_response(conn, response, request_id)
         print(f"USERLIST sent to {username}")
         return True
+    if msg_type == "FETCH_HISTORY":
+        return await handle_fetch_history(msg, username, conn, room)
+    if msg_type == "FETCH_MENTIONS":
+        return await handle_fetch_mentions(msg, username, conn, room)
+    if msg_type == "SEARCH":
+        return await handle_search(msg, username, conn, room)
+    if msg_type == "FETCH_ROOM_LIST":
+        return await handle_room_list(msg, username, conn, rooms)
+    if msg_type == "JOIN_ROOM":
+        return await handle_join_room(clients, msg, username, conn, rooms)
+    if msg_type == "LEAVE_ROOM":
+        return handle_leave_room(msg, username, conn, rooms)
     if msg_type == "CHANGE_USERNAME":
-        return await handle_change_username(clients, msg, username, writer, broadcast)
+        return await handle_change_username(clients, msg, username, conn, rooms)
 
     return False
 
-async def handle_change_username(clients, msg, username, writer, broadcast):
+
+async def handle_room_list(msg, username, conn, rooms):
+    room_list = await rooms.room_list()
+    response = createMessage(sender="Server", type=MSG_ROOM_LIST, content=room_list)
+    send_response(conn, response, msg.get('request_id'))
+    print(f"ROOM_LIST sent to {username}")
+    return True
+
+
+async def handle_join_room(clients, msg, username, conn, rooms):
+    request_id = msg.get('request_id')
+    query = msg.get('content')
+    if isinstance(query, str):
+        query = {"room": query}
+    if not isinstance(query, dict):
+        query = {}
+
+    room_name = query.get('room')
+    if not valid_room_name(room_name):
+        response = createMessage(sender="Server", type=MSG_ERROR, content="Room names can only use letters, numbers, - and _ (max 32)")
+        send_response(conn, response, request_id)
+        return False
+
+    try:
+        room = await rooms.get(room_name)
+        if username in room.members:
+            response = createMessage(sender="Server", type=MSG_ERROR, content=f"You are already in #{room_name}")
+            send_response(conn, response, request_id)
+            return False
+
+        # The connection may have gone away while the room was opening
+        if clients.get(username) is not conn or conn.closed:
+            room.check_idle()
+            return False
+
+        welcome = createMessage(sender="Server", type=MSG_SUCCESS, content=f"Joined #{room_name}")
+        if request_id:
+            welcome['request_id'] = request_id
+        await room.join(username, conn, welcome, cursor_value(query, 'last_seen_seq'))
+    except RoomLimitReached as e:
+        send_response(conn, createMessage(sender="Server", type=MSG_ERROR, content=str(e)), request_id)
+        return False
+    print(f"{username} joined #{room_name}")
+    return True
+
+
+def handle_leave_room(msg, username, conn, rooms):
+    request_id = msg.get('request_id')
+    room_name = msg.get('content')
+    room = rooms.get_open(room_name) if valid_room_name(room_name) else None
+
+    if room is None or not room.remove_member(username):
+        response = createMessage(sender="Server", type=MSG_ERROR, content=f"You are not in #{room_name}")
+        send_response(conn, response, request_id)
+        return False
+
+    response = createMessage(sender="Server", type=MSG_SUCCESS, content=f"Left #{room_name}")
+    response['room'] = room_name
+    send_response(conn, response, request_id)
+    print(f"{username} left #{room_name}")
+    return True
+
+def cursor_value(query, key):
+    value = query.get(key)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def page_query(msg):
+    # The request's options and how many messages it may have
+    query = msg.get('content')
+    if not isinstance(query, dict):
+        query = {}
+    limit = cursor_value(query, 'limit') or HISTORY_PAGE_SIZE
+    return query, max(1, min(limit, HISTORY_PAGE_SIZE))
+
+
+async def send_page(conn, request_id, room, read, what):
+    # Answers with one page of stored messages from read, a coroutine
+    # returning (lines, has_more), or an error naming what failed to load
+    try:
+        lines, has_more = await read
+        response = createMessage(sender="Server", type=MSG_HISTORY, content=[json.loads(line) for line in lines])
+        response['has_more'] = has_more
+        response['room'] = room.name
+    except Exception as e:
+        print(f"Error loading {what} from #{room.name}: {e}")
+        response = createMessage(sender="Server", type=MSG_ERROR, content=f"Could not load {what}")
+    send_response(conn, response, request_id)
+
+
+async def handle_fetch_history(msg, username, conn, room):
+    query, limit = page_query(msg)
+    before_time = query.get('before_time')
+    if not isinstance(before_time, str):
+        before_time = None
+
+    await send_page(conn, msg.get('request_id'), room, room.fetch_history(
+        before=cursor_value(query, 'before'),
+        after=cursor_value(query, 'after'),
+        before_time=before_time,
+        limit=limit
+    ), "history")
+    print(f"HISTORY page sent to {username}")
+    return True
+
+
+async def handle_fetch_mentions(msg, username, conn, room):
+    # Messages in the room mentioning the sender after the `after` seq,
+    # oldest first. The last seq returned is the cursor for the next call.
+    query, limit = page_query(msg)
+    await send_page(conn, msg.get('request_id'), room, room.fetch_mentions(
+        username, after=cursor_value(query, 'after'), limit=limit
+    ), "mentions")
+    print(f"MENTIONS sent to {username}")
+    return True
+
+
+async def handle_search(msg, username, conn, room):
+    # The newest messages in the room matching every search term, before
+    # the `before` seq, oldest first. The first seq returned is the cursor
+    # for the next (older) page.
+    query, limit = page_query(msg)
+    if not isinstance(query.get('query'), str) or not query['query'].strip():
+        send_response(conn, createMessage(sender="Server", type=MSG_ERROR, content="Search needs some terms"), msg.get('request_id'))
+        return True
+
+    await send_page(conn, msg.get('request_id'), room, room.search(
+        query['query'], before=cursor_value(query, 'before'), limit=limit
+    ), "search results")
+    print(f"SEARCH results sent to {username}")
+    return True
+
+
+async def handle_change_username(clients, msg, username, conn, rooms):
     new_name = msg["content"]
     request_id = msg.get('request_id')
+    if not valid_username(new_name):
+        send_response(conn, createMessage(sender="Server", type=MSG_ERROR, content=USERNAME_RULES), request_id)
+        return False
     print(f"Changing client's name from {username} to {new_name}")
-    if new_name in clients.keys():
+    if new_name in clients.keys() or not await rooms.claim_username(new_name):
         print(f"{new_name} already taken")
         response = createMessage(
                 sender="Server",
@@ -37,13 +214,13 @@ async def handle_change_username(clients, msg, username, writer, broadcast):
         if request_id:
             response['request_id'] = request_id
 
-        writer.write(serialize(response))
-        await writer.drain()
+        conn.send_control(Message(response))
 
         return False
 
     clients[new_name] = clients[username]
     del clients[username]
+    rooms.release_username(username)
 
     print(f"{username} succesfully changed to {new_name}")
 
@@ -56,17 +233,15 @@ async def handle_change_username(clients, msg, username, writer, broadcast):
     if request_id:
         response['request_id'] = request_id
 
-    writer.write(serialize(response))
-    await writer.drain()
+    conn.send_control(Message(response))
 
-    updated_client_list = createMessage(
-            sender="Server",
-            type=MSG_USERLIST,
-            content=list(clients.keys())
-            )
-    update_message = createMessage(sender="Server", type=MSG_MESSAGE, content=f"[green]{username} changed their username to {new_name} using /nick")
-    await broadcast(updated_client_list)
-    await broadcast(update_message)
+    for room_name in list(conn.rooms):
+        room = rooms.get_open(room_name)
+        if room is None:
+            continue
+        room.rename_member(username, new_name)
+        update_message = createMessage(sender="Server", type=MSG_MESSAGE, content=f"[green]{username} changed their username to {new_name} using /nick")
+        room.broadcast(update_message)
 
 
     return new_name
@@ -0,0 +1,254 @@
+import asyncio
+import os
+import time
+from protocal import *
+from server_history import History
+from server_presence import Presence
+from server_metrics import metrics
+from server_mentions import mentioned_users, mention_event
+from server_settings import MAX_OPEN_ROOMS
+
+
+class RoomLimitReached(Exception):
+    pass
+
+
+def deliver(members, message, exclude=None, control=False):
+    # Fan a message out to the members connected to this process
+    started = time.perf_counter()
+    sent = 0
+    for username, conn in list(members.items()):
+        if username == exclude:
+            continue
+        if control:
+            conn.send_control(message)
+        else:
+            conn.send(message)
+        sent += 1
+    metrics.count("messages_out", sent)
+    metrics.observe("broadcast", time.perf_counter() - started)
+
+
+def join_notice(username, room_name):
+    return createMessage(sender="Server", type=MSG_JOIN, content=f"{username} has joined #{room_name}")
+
+
+def leave_notice(username, room_name):
+    return createMessage(sender="Server", type=MSG_LEAVE, content=f"{username} has left #{room_name}")
+
+
+class Room:
+    # A named channel with its own subscribers, history stream and presence,
+    # so fan-out only ever touches the people who are in it.
+
+    def __init__(self, name, directory, legacy_file=None, notify=None, on_idle=None):
+        self.name = name
+        self.members = {}
+        self.history = History(directory, legacy_file)
+        self.presence = Presence(name)
+        # notify(username, message) reaches a user wherever they are connected
+        self.notify = notify
+        # on_idle(room) is called once nobody is in the room any more
+        self.on_idle = on_idle
+        self.joining = 0
+
+    async def open(self):
+        await self.history.open()
+
+    async def close(self):
+        await self.history.close()
+
+    def deliver(self, message, exclude=None, control=False):
+        deliver(self.members, message, exclude, control)
+
+    def broadcast(self, message, exclude=None):
+        message['room'] = self.name
+        # Presence goes with the replies, ahead of live chat and any replay
+        self.deliver(Message(message), exclude, control=message.get('type') in PRESENCE_EVENTS)
+
+    def publish(self, message):
+        message['room'] = self.name
+        users = mentioned_users(message)
+        self.deliver(self.history.append(message, users))
+        if users and self.notify:
+            for username in users:
+                self.notify(username, Message(mention_event(message, self.name, message['seq'])))
+
+    async def join(self, username, conn, welcome, last_seen_seq=None):
+        gap = await self.join_gap(last_seen_seq)
+        return self.add_member(username, conn, welcome, gap)
+
+    async def join_gap(self, last_seen_seq):
+        # The room can't close while a join waits on the disk
+        if last_seen_seq is None:
+            return None
+        self.joining += 1
+        try:
+            return await self.history.read_gap(last_seen_seq)
+        finally:
+            self.joining -= 1
+
+    def check_idle(self):
+        if self.on_idle and not self.members and not self.presence.users and not self.joining:
+            self.on_idle(self)
+
+    async def fetch_history(self, before=None, after=None, before_time=None, limit=None):
+        return await self.history.fetch(before=before, after=after, before_time=before_time, limit=limit)
+
+    async def fetch_mentions(self, username, after=None, limit=None):
+        return await self.history.fetch_mentions(username, after, limit)
+
+    async def search(self, query, before=None, limit=None):
+        return await self.history.search(query, before, limit)
+
+    def add_member(self, username, conn, welcome, gap=None):
+        # Synchronous from registration until the replay is queued, so live
+        # messages in this room always land after it
+        self.members[username] = conn
+        conn.rooms.add(self.name)
+
+        started = time.perf_counter()
+        chunks = self.history.replay_chunks(gap) if gap is not None else None
+        resync = chunks is None
+        if resync:
+            chunks = self.history.replay_chunks()
+
+        welcome['room'] = self.name
+        welcome['resync'] = resync
+        welcome['last_seq'] = self.history.last_seq
+        conn.send_control(Message(welcome))
+        for chunk in chunks:
+            conn.send_bulk(chunk)
+        metrics.observe("replay", time.perf_counter() - started)
+
+        self.publish(join_notice(username, self.name))
+
+        # The newcomer gets the full list, everyone else just the delta. The
+        # list marks the end of the replay, so it queues behind it.
+        self.broadcast(self.presence.joined(username), exclude=username)
+        conn.send_bulk(Message(self.presence.full_list()))
+        return len(chunks)
+
+    def remove_member(self, username):
+        conn = self.members.pop(username, None)
+        if conn is None:
+            return False
+        conn.rooms.discard(self.name)
+
+        self.publish(leave_notice(username, self.name))
+        left_msg = self.presence.left(username)
+        if left_msg:
+            self.broadcast(left_msg)
+        self.check_idle()
+        return True
+
+    def rename_member(self, old_name, new_name):
+        if old_name not in self.members:
+            return
+        self.members[new_name] = self.members.pop(old_name)
+        self.broadcast(self.presence.renamed(old_name, new_name))
+
+
+class Rooms:
+    # Rooms are opened on first use and closed (history flushed, files and
+    # tasks released) once the last member leaves, so only rooms in use
+    # cost anything. The default room stays open and keeps using the
+    # original chat_history folder.
+
+    def __init__(self, history_dir, legacy_file=None, clients=None):
+        self.history_dir = history_dir
+        self.legacy_file = legacy_file
+        self.clients = clients
+        self.rooms = {}
+        self.opening = {}
+        self.closing = {}
+        self.usernames = set()
+
+    async def claim_username(self, username):
+        if username in self.usernames:
+            return False
+        self.usernames.add(username)
+        return True
+
+    def release_username(self, username):
+        self.usernames.discard(username)
+
+    def notify(self, username, message):
+        conn = self.clients.get(username) if self.clients is not None else None
+        if conn:
+            conn.send(message)
+
+    def directory_for(self, name):
+        if name == DEFAULT_ROOM:
+            return self.history_dir
+        return os.path.join(self.history_dir, "rooms", name)
+
+    def names(self):
+        names = set(self.rooms.keys())
+        try:
+            names.update(
+                name for name in os.listdir(os.path.join(self.history_dir, "rooms"))
+                if valid_room_name(name)
+            )
+        except FileNotFoundError:
+            pass
+        names.add(DEFAULT_ROOM)
+        return sorted(names)
+
+    async def room_list(self):
+        room_list = []
+        for name in self.names():
+            room = self.rooms.get(name)
+            room_list.append({"name": name, "users": len(room.presence.users) if room else 0})
+        return room_list
+
+    def get_open(self, name):
+        return self.rooms.get(name)
+
+    async def get(self, name):
+        room = self.rooms.get(name)
+        if room:
+            return room
+        if name in self.closing:
+            # Reopen only once everything it had is on disk
+            await asyncio.shield(self.closing[name])
+            room = self.rooms.get(name)
+            if room:
+                return room
+        if name not in self.opening:
+            if len(self.rooms) + len(self.opening) >= MAX_OPEN_ROOMS and name != DEFAULT_ROOM:
+                raise RoomLimitReached("Too many rooms are open right now, try again later")
+            self.opening[name] = asyncio.ensure_future(self._open(name))
+        return await asyncio.shield(self.opening[name])
+
+    def idle(self, room):
+        if room.name == DEFAULT_ROOM or self.rooms.get(room.name) is not room:
+            return
+        del self.rooms[room.name]
+        self.closing[room.name] = asyncio.ensure_future(self._close(room))
+
+    async def _close(self, room):
+        try:
+            await room.close()
+            print(f"Closed room #{room.name}")
+        except Exception as e:
+            print(f"Error closing room #{room.name}: {e}")
+        finally:
+            del self.closing[room.name]
+
+    async def _open(self, name):
+        try:
+            legacy_file = self.legacy_file if name == DEFAULT_ROOM else None
+            room = Room(name, self.directory_for(name), legacy_file, self.notify, self.idle)
+            await room.open()
+            self.rooms[name] = room
+            print(f"Opened room #{name}")
+            return room
+        finally:
+            del self.opening[name]
+
+    async def close(self):
+        for room in list(self.rooms.values()):
+            await room.close()
+        if self.closing:
+            await asyncio.gather(*self.closing.values(), return_exceptions=True)
@@ -0,0 +1,59 @@
+import re
+from bisect import bisect_left
+from protocal import *
+from server_postings import Postings, contains
+
+# Full-text search. Every room keeps an inverted index, token -> seqs of the
+# messages containing it, in seq order. It is updated as messages are
+# stored and rebuilt from the log when the room opens.
+TOKEN_PATTERN = re.compile(r'\w+')
+MAX_TOKEN_CHARS = 32
+MAX_QUERY_TERMS = 8
+SEARCHABLE_TYPES = (MSG_MESSAGE,)
+
+
+def tokenize(text):
+    return {token for token in TOKEN_PATTERN.findall(text.lower()) if len(token) <= MAX_TOKEN_CHARS}
+
+
+def message_tokens(message):
+    content = message.get('content')
+    if message.get('type') not in SEARCHABLE_TYPES or not isinstance(content, str):
+        return ()
+    tokens = tokenize(content)
+    sender = message.get('sender')
+    if isinstance(sender, str):
+        tokens.update(tokenize(sender))
+    return tokens
+
+
+class SearchIndex(Postings):
+
+    def add(self, seq, message):
+        super().add(seq, message_tokens(message))
+
+    def search(self, query, before=None, limit=20):
+        # Seqs of the newest messages before the cursor that contain every
+        # term, oldest first, and whether there are more
+        terms = list(tokenize(query))[:MAX_QUERY_TERMS]
+        if not terms:
+            return [], False
+        lists = []
+        for term in terms:
+            seqs = self.seqs.get(term)
+            if not seqs:
+                return [], False
+            lists.append(seqs)
+
+        # Walk the rarest term backwards and binary search the others
+        lists.sort(key=len)
+        rarest, others = lists[0], lists[1:]
+        i = bisect_left(rarest, before) if before is not None else len(rarest)
+        found = []
+        while i > 0 and len(found) <= limit:
+            i -= 1
+            seq = rarest[i]
+            if all(contains(seqs, seq) for seqs in others):
+                found.append(seq)
+        has_more = len(found) > limit
+        return found[:limit][::-1], has_more
@@ -0,0 +1,75 @@
+import os
+
+
+def env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        print(f"Invalid value for {name}, using default {default}")
+        return default
+
+
+def env_str(name, default, choices=None):
+    value = os.environ.get(name, default).strip().lower()
+    if choices and value not in choices:
+        print(f"Invalid value for {name}: {value}, using default {default}")
+        return default
+    return value
+
+
+# Outbound fan-out
+OUTBOUND_QUEUE_SIZE = env_int('OUTBOUND_QUEUE_SIZE', 1024)
+SLOW_CONSUMER_POLICY = env_str('SLOW_CONSUMER_POLICY', 'drop_oldest', ('drop_oldest', 'drop_new', 'disconnect'))
+# Bytes waiting for one client, in any lane, before it is disconnected
+OUTBOUND_MAX_BYTES = env_int('OUTBOUND_MAX_BYTES', 8 * 1024 * 1024)
+# Queued messages sent in one write per client, 0 writes them one at a time
+WRITE_COALESCE_BYTES = env_int('WRITE_COALESCE_BYTES', 65536)
+
+# Heartbeat, 0 turns it off
+HEARTBEAT_INTERVAL_S = env_int('HEARTBEAT_INTERVAL_S', 15)
+HEARTBEAT_TIMEOUT_S = env_int('HEARTBEAT_TIMEOUT_S', 45)
+
+# Inbound limits per connection, a rate of 0 turns that limit off
+MAX_FRAME_BYTES = env_int('MAX_FRAME_BYTES', 8192)
+MAX_MESSAGE_CHARS = env_int('MAX_MESSAGE_CHARS', 500)
+RATE_LIMIT_MESSAGES = env_int('RATE_LIMIT_MESSAGES', 5)
+RATE_LIMIT_MESSAGE_BURST = env_int('RATE_LIMIT_MESSAGE_BURST', 20)
+RATE_LIMIT_BYTES = env_int('RATE_LIMIT_BYTES', 16384)
+RATE_LIMIT_BYTE_BURST = env_int('RATE_LIMIT_BYTE_BURST', 65536)
+
+# Rooms other than the default one close when their last member leaves,
+# and at most this many can be open at once
+MAX_OPEN_ROOMS = env_int('MAX_OPEN_ROOMS', 100)
+
+# JOIN handshakes running at once, 0 for no limit, and how many more may wait
+ADMISSION_MAX_HANDSHAKES = env_int('ADMISSION_MAX_HANDSHAKES', 16)
+ADMISSION_QUEUE_SIZE = env_int('ADMISSION_QUEUE_SIZE', 256)
+# Clients give up on the handshake after 5s, so a refusal must come sooner
+ADMISSION_WAIT_S = env_int('ADMISSION_WAIT_S', 3)
+
+# History writer
+HISTORY_BATCH_SIZE = env_int('HISTORY_BATCH_SIZE', 256)
+HISTORY_FLUSH_INTERVAL_MS = env_int('HISTORY_FLUSH_INTERVAL_MS', 50)
+HISTORY_DURABILITY = env_str('HISTORY_DURABILITY', 'none', ('none', 'batch', 'interval'))
+HISTORY_FSYNC_INTERVAL_MS = env_int('HISTORY_FSYNC_INTERVAL_MS', 1000)
+
+# History replay on join
+HISTORY_REPLAY_SIZE = env_int('HISTORY_REPLAY_SIZE', 1000)
+HISTORY_RESUME_LIMIT = env_int('HISTORY_RESUME_LIMIT', 5000)
+HISTORY_SEGMENT_BYTES = env_int('HISTORY_SEGMENT_BYTES', 16 * 1024 * 1024)
+HISTORY_INDEX_INTERVAL = env_int('HISTORY_INDEX_INTERVAL', 64)
+HISTORY_PAGE_SIZE = env_int('HISTORY_PAGE_SIZE', 100)
+# Threads doing history disk work, shared by all rooms
+HISTORY_THREADS = env_int('HISTORY_THREADS', 4)
+
+# History retention and compression of old segments, a limit of 0 keeps
+# everything
+HISTORY_RETENTION_DAYS = env_int('HISTORY_RETENTION_DAYS', 0)
+HISTORY_RETENTION_MESSAGES = env_int('HISTORY_RETENTION_MESSAGES', 0)
+HISTORY_RETENTION_BYTES = env_int('HISTORY_RETENTION_BYTES', 0)
+HISTORY_COMPRESSION = env_str('HISTORY_COMPRESSION', 'gzip', ('gzip', 'none'))
+HISTORY_MAINTENANCE_INTERVAL_S = env_int('HISTORY_MAINTENANCE_INTERVAL_S', 60)
+
+# Metrics
+METRICS_FILE = os.environ.get('METRICS_FILE', '')
+METRICS_INTERVAL_S = env_int('METRICS_INTERVAL_S', 10)